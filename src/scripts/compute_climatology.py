@@ -0,0 +1,37 @@
+''' Monthly climatology (per-pixel mean and standard deviation over several years) of the CHELSA rasters.
+
+Streams the monthly rasters of every year in blocks of rows, so the whole 1979-2013 timeseries can be
+processed at any resolution with bounded memory. Writes memory-mapped .npy stacks of shape (12, H, W).
+
+The default --kernel-size 10 matches the grid of the clustering and writes about 1.1 GB per variable;
+--kernel-size 1 (full resolution) writes about 108 GB per variable.
+
+Usage (from the root of the repository):
+    python -m src.scripts.compute_climatology --data-folder data/ --output-folder data/climatology/ --kernel-size 10
+'''
+import argparse
+
+from src.utils.geospatial_utils import compute_climatology
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-pixel monthly climatology of the CHELSA rasters.")
+    parser.add_argument('--data-folder', default='data/', help="Folder with the CHELSA subfolders")
+    parser.add_argument('--output-folder', default='data/climatology/')
+    parser.add_argument('--variables', nargs='+', default=['tmean', 'prec'])
+    parser.add_argument('--first-year', type=int, default=1979)
+    parser.add_argument('--last-year', type=int, default=2013)
+    parser.add_argument('--kernel-size', type=int, default=10,
+                        help="Downsampling factor (default: 10, ~1.1 GB per variable; 1 for the full resolution, ~108 GB per variable)")
+    parser.add_argument('--block-rows', type=int, default=256)
+    args = parser.parse_args()
+
+    for variable in args.variables:
+        climatology = compute_climatology(args.data_folder, args.output_folder, variable,
+                                          years=range(args.first_year, args.last_year + 1),
+                                          kernel_size=args.kernel_size, block_rows=args.block_rows)
+        print(f"[INFO] :: {variable} climatology of shape {climatology['mean'].shape} written to {args.output_folder}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+''' Monthly climate statistics of every admin-1 region of the world.
+
+Computes count, mean, std, min and max of the CHELSA monthly temperature and precipitation rasters for every
+region of ne_50m_admin_1_states_provinces, at full resolution, and writes them as one tidy table.
+
+Usage (from the root of the repository):
+    python -m src.scripts.compute_regional_climate --data-folder data/ --output data/regional_climate.csv
+'''
+import argparse
+import os
+
+import geopandas as gpd
+
+from src.utils.geospatial_utils import chelsa_paths, regional_climate_statistics
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Monthly climate statistics of every admin-1 region.")
+    parser.add_argument('--data-folder', default='data/', help="Folder with the CHELSA subfolders and the Natural Earth shapefiles")
+    parser.add_argument('--output', default=None, help="Output table (.csv or .parquet)")
+    parser.add_argument('--variables', nargs='+', default=['tmean', 'prec'])
+    parser.add_argument('--year', type=int, default=2013)
+    parser.add_argument('--tile-degrees', type=float, default=30)
+    parser.add_argument('--n-jobs', type=int, default=None)
+    args = parser.parse_args()
+
+    regions = gpd.read_file(os.path.join(args.data_folder, 'ne_50m_admin_1_states_provinces/ne_50m_admin_1_states_provinces.shp'))
+    files = {variable: chelsa_paths(args.data_folder, variable, args.year) for variable in args.variables}
+
+    climate_df = regional_climate_statistics(regions, files, tile_degrees=args.tile_degrees, n_jobs=args.n_jobs)
+
+    # Identify regions by name and country, as in the rest of the analysis
+    names = regions[['name', 'admin']].rename(columns={'admin': 'country'})
+    climate_df = names.join(climate_df.set_index('region'), how='inner').reset_index(names='region')
+
+    output = args.output or os.path.join(args.data_folder, 'regional_climate.csv')
+    if output.endswith('.parquet'):
+        climate_df.to_parquet(output, index=False)
+    else:
+        climate_df.to_csv(output, index=False)
+    print(f"[INFO] :: {len(climate_df)} rows written to {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,7 @@
 import pandas as pd
 import numpy as np
 import time
+from concurrent.futures import ProcessPoolExecutor
 
 def preprocess_beers_df(beers_df):
     """
@@ -320,3 +321,145 @@ def get_beer_style_mapping() -> map:
         ]
     }
     return {style: category for category, styles in style_categories.items() for style in styles}
+
+
+def _minhash_signatures(texts, num_perm, shingle_size, seed):
+    """ Computes the MinHash signatures (num_perm uint32 values per text) of word shingles
+
+    Args:
+        texts (array-like of str): the texts
+        num_perm (int): number of hash functions (signature length)
+        shingle_size (int): number of consecutive words per shingle
+        seed (int): seed of the hash functions, must be identical for all the chunks
+
+    Returns:
+        np.ndarray: signatures of shape (len(texts), num_perm), empty and missing texts get the maximal value
+    """
+    rng = np.random.default_rng(seed)
+    multipliers = rng.integers(1, 2**63, size=num_perm, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+    offsets = rng.integers(0, 2**63, size=num_perm, dtype=np.uint64)
+
+    # Missing texts (NaN/None) have no shingles, so they never match each other
+    word_lists = [text.lower().split() if isinstance(text, str) else [] for text in texts]
+    n_words = np.fromiter(map(len, word_lists), dtype=np.int64, count=len(word_lists))
+    signatures = np.full((len(word_lists), num_perm), np.iinfo(np.uint32).max, dtype=np.uint32)
+    if n_words.sum() == 0:
+        return signatures
+    words = np.fromiter((w for word_list in word_lists for w in word_list), dtype=object, count=n_words.sum())
+    word_hashes = pd.util.hash_array(words)
+    doc = np.repeat(np.arange(len(word_lists)), n_words)
+
+    # Shingle hashes are combined from the word hashes, texts shorter than a shingle form a single shingle
+    starts = np.flatnonzero(doc[:len(doc) - shingle_size + 1] == doc[shingle_size - 1:])
+    hashes = word_hashes[starts]
+    for k in range(1, shingle_size):
+        hashes = hashes * np.uint64(0x9e3779b97f4a7c15) + word_hashes[starts + k]
+        hashes = hashes ^ (hashes >> np.uint64(29))
+    short = np.flatnonzero((n_words > 0) & (n_words < shingle_size))
+    short_hashes = pd.util.hash_array(np.array([' '.join(word_lists[i]) for i in short], dtype=object))
+    shingle_doc = np.concatenate([doc[starts], short])
+    order = np.argsort(shingle_doc, kind='stable')
+    hashes = np.concatenate([hashes, short_hashes])[order]
+    shingle_doc = shingle_doc[order]
+
+    non_empty, starts = np.unique(shingle_doc, return_index=True)
+
+    # Multiply-shift hashing gives one independent permutation per signature row
+    for k in range(num_perm):
+        permuted = ((hashes * multipliers[k] + offsets[k]) >> np.uint64(32)).astype(np.uint32)
+        signatures[non_empty, k] = np.minimum.reduceat(permuted, starts)
+    return signatures
+
+
+def _minhash_worker(args):
+    texts, num_perm, shingle_size, seed = args
+    return _minhash_signatures(texts, num_perm, shingle_size, seed)
+
+
+def find_near_duplicate_reviews(df: pd.DataFrame, text_column: str = 'text', num_perm: int = 64, bands: int = 16,
+                                shingle_size: int = 3, threshold: float = 0.8, block_on: list = None,
+                                chunk_size: int = 50000, n_jobs: int = 1, max_bucket_size: int = 1000,
+                                seed: int = 0) -> pd.DataFrame:
+    """ Find near-duplicate reviews (e.g. the same review cross-posted on both websites with small edits)
+        with MinHash signatures and LSH banding, without comparing all pairs of reviews
+
+    Args:
+        df (pd.DataFrame): the ratings dataframe containing the text reviews
+        text_column (str): column containing the review text
+        num_perm (int): length of the MinHash signatures, must be a multiple of bands
+        bands (int): number of LSH bands. Pairs with Jaccard similarity s become candidates
+            with probability 1 - (1 - s^r)^bands where r = num_perm / bands
+        shingle_size (int): number of consecutive words per shingle
+        threshold (float): minimum estimated Jaccard similarity of the returned pairs
+        block_on (list): optional columns (e.g. ['beer_name']) that must be equal for both reviews of a pair
+        chunk_size (int): number of reviews hashed per task
+        n_jobs (int): number of processes computing the signatures
+        max_bucket_size (int): LSH buckets larger than this (e.g. boilerplate texts) are skipped
+        seed (int): seed of the MinHash functions
+
+    Returns:
+        pd.DataFrame: candidate pairs with columns 'idx_a', 'idx_b' (positions in df, idx_a < idx_b) and 'jaccard'
+    """
+    if num_perm % bands != 0:
+        raise ValueError("num_perm must be a multiple of bands.")
+    rows_per_band = num_perm // bands
+    texts = df[text_column].to_numpy()
+
+    print("[INFO] :: Computing MinHash signatures...", end='', flush=True)
+    chunks = [(texts[i:i + chunk_size], num_perm, shingle_size, seed) for i in range(0, len(texts), chunk_size)]
+    if n_jobs == 1:
+        parts = [_minhash_worker(chunk) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            parts = list(executor.map(_minhash_worker, chunks))
+    signatures = np.concatenate(parts) if parts else np.empty((0, num_perm), dtype=np.uint32)
+    print("OK", flush=True)
+
+    print("[INFO] :: Finding candidate pairs with LSH...", end='', flush=True)
+    empty = (signatures == np.iinfo(np.uint32).max).all(axis=1)
+    candidates = []
+    for band in range(bands):
+        band_hashes = pd.util.hash_pandas_object(pd.DataFrame(signatures[:, band * rows_per_band:(band + 1) * rows_per_band]), index=False).to_numpy()
+        order = np.argsort(band_hashes, kind='stable')
+        order = order[~empty[order]]
+        sorted_hashes = band_hashes[order]
+        boundaries = np.flatnonzero(np.diff(sorted_hashes)) + 1
+        starts = np.concatenate([[0], boundaries])
+        sizes = np.diff(np.concatenate([starts, [len(order)]]))
+        for start, size in zip(starts[(sizes > 1) & (sizes <= max_bucket_size)], sizes[(sizes > 1) & (sizes <= max_bucket_size)]):
+            members = np.sort(order[start:start + size])
+            a, b = np.triu_indices(size, k=1)
+            candidates.append(np.stack([members[a], members[b]], axis=1))
+    pairs = np.unique(np.concatenate(candidates), axis=0) if candidates else np.empty((0, 2), dtype=np.int64)
+
+    if block_on is not None and len(pairs) > 0:
+        keys = pd.MultiIndex.from_frame(df[block_on]).codes
+        same = np.logical_and.reduce([codes[pairs[:, 0]] == codes[pairs[:, 1]] for codes in keys])
+        pairs = pairs[same]
+
+    jaccard = (signatures[pairs[:, 0]] == signatures[pairs[:, 1]]).mean(axis=1) if len(pairs) > 0 else np.empty(0)
+    keep = jaccard >= threshold
+    print("OK", flush=True)
+    print("Total # of near-duplicate pairs: {0}".format(keep.sum()))
+
+    return pd.DataFrame({'idx_a': pairs[keep, 0], 'idx_b': pairs[keep, 1], 'jaccard': jaccard[keep]})
+
+
+def remove_near_duplicate_reviews(df: pd.DataFrame, pairs: pd.DataFrame) -> pd.DataFrame:
+    """ Remove near-duplicate reviews found by find_near_duplicate_reviews, keeping the first review of each pair
+
+    Args:
+        df (pd.DataFrame): the ratings dataframe given to find_near_duplicate_reviews
+        pairs (pd.DataFrame): the near-duplicate pairs (positions in df)
+
+    Returns:
+        pd.DataFrame: filtered dataframe without the near-duplicate reviews
+    """
+    count_before = df.index.size
+    to_drop = np.zeros(count_before, dtype=bool)
+    to_drop[pairs['idx_b'].to_numpy(dtype=np.int64)] = True
+    df_no_near_duplicates = df[~to_drop]
+
+    count_after = df_no_near_duplicates.index.size
+    print("Total # of ratings after removing near-duplicates: {0} --> Difference: {1}".format(count_after, count_before-count_after))
+    return df_no_near_duplicates
@@ -1,51 +1,292 @@
 import numpy as np
 import pandas as pd
 import os
-import torch
-from sklearn.cluster import KMeans
+import json
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.metrics import silhouette_score
+from scipy.spatial import cKDTree
+from joblib import Parallel, delayed
 from sklearn.preprocessing import StandardScaler
 
 # Geospatial analyses
 import geopandas as gpd
 import rasterio
 from rasterio.transform import from_origin
-from rasterio.features import geometry_mask
-from shapely.geometry import Point, shape
+from rasterio.windows import Window, transform as window_transform
+from shapely.geometry import Point, box, shape
 from shapely.ops import unary_union
-from collections import Counter
+import shapely
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from IPython.display import HTML
+from src.utils.raster_utils import downsample, geometry_digest, geometry_pixels, geometry_window, ZonalStats
 
 # Visualization libraries
 import matplotlib.pyplot as plt
 from matplotlib.animation import FuncAnimation
 from matplotlib.colors import Normalize
+from matplotlib.collections import PatchCollection
+from matplotlib.patches import PathPatch
+from matplotlib.path import Path
 import matplotlib.cm as cm
 import plotly.graph_objects as go
 import plotly.io as pio
 
-def load_geotiff(file_name):
+def load_geotiff(file_name, kernel_size=10, block_rows=500, method='mean', mask_nodata=True, out=None):
     ''' Load .tiff files containing climatic data
     
+    The raster is read in windows of rows aligned to the pooling kernel and each window is pooled as soon
+    as it is read, so the peak memory is a few blocks instead of the full band. Since the pooling windows
+    never straddle two blocks, the result is the same as pooling the full band at once.
+
     Input:
         file_name: str
             Path to .tiff file
 
+        kernel_size: int
+            Downsampling factor
+
+        block_rows: int
+            Number of raster rows read at once (rounded down to a multiple of kernel_size)
+
+        method: str
+            Downsampling method: 'mean', 'nanmean', 'max' or 'min' (see raster_utils.downsample)
+
+        mask_nodata: bool
+            Ignore the nodata (ocean fill) pixels of the raster instead of averaging them into land pixels.
+            Pixels without any valid value become NaN.
+
+        out: np.array or None
+            Preallocated float32 array of the downscaled shape to write the result into
+
     Output:
         data: np.array
             2d downscaled array containing climatic values in each pixel
     
     '''
-    
-    _ = np.newaxis
-    # downsampling_layer = torch.nn.MaxPool2d(kernel_size=10, stride=10)
-    downsampling_layer = torch.nn.AvgPool2d(kernel_size=10, stride=10)
-    # downsampling_layer = torch.nn.Conv2d(1, 1, kernel_size=10, stride=10)
+    block_rows = max(kernel_size, block_rows - block_rows % kernel_size)
 
     with rasterio.open(file_name) as src:
-        array = src.read(1, out_dtype=np.float32)
-        data = downsampling_layer(torch.tensor(array[_,_,:,:], dtype=torch.float32)).detach().numpy()
+        nodata = src.nodata if mask_nodata else None
+        out_height, out_width = src.height // kernel_size, src.width // kernel_size
+        data = np.empty((out_height, out_width), dtype=np.float32) if out is None else out
+
+        for row_off in range(0, out_height * kernel_size, block_rows):
+            height = min(block_rows, out_height * kernel_size - row_off)
+            window = Window(0, row_off, out_width * kernel_size, height)
+            block = src.read(1, window=window)
+            data[row_off // kernel_size:(row_off + height) // kernel_size] = downsample(block, kernel_size, method, nodata)
+
+    return data
+
+
+# CHELSA monthly timeseries files, and the data subfolder of each variable
+CHELSA_FILE_PATTERN = "CHELSA_{variable}_{year}_{month:02d}_V1.2.1.tif"
+CHELSA_FOLDERS = {'tmean': 'temp', 'prec': 'prec'}
+
+
+def chelsa_paths(data_folder, variable, year=2013, months=range(1, 13)):
+    ''' Build the paths of the monthly CHELSA files of a variable
+    
+    Input:
+        data_folder: str
+            Folder containing one subfolder per variable (see CHELSA_FOLDERS)
+
+        variable: str
+            'tmean' or 'prec'
+
+        year: int
+            Year of the timeseries
+
+        months: iterable of int
+            Months to load (1 to 12)
+
+    Output:
+        paths: list of str
+    '''
+    folder = os.path.join(data_folder, CHELSA_FOLDERS.get(variable, variable))
+    return [os.path.join(folder, CHELSA_FILE_PATTERN.format(variable=variable, year=year, month=month)) for month in months]
+
+
+def load_geotiff_stack(paths, kernel_size=10, max_workers=None, out=None, **kwargs):
+    ''' Load and downsample several .tiff files concurrently into one preallocated stack
+    
+    rasterio releases the GIL while decoding, so the files are read in a thread pool and the
+    wall time is bounded by the disk bandwidth rather than by serial decoding.
+
+    Input:
+        paths: list of str
+            Paths to .tiff files with the same shape (e.g. the 12 months of a variable)
+
+        kernel_size: int
+            Downsampling factor
+
+        max_workers: int or None
+            Number of threads (default: one per file, up to the number of CPUs + 4)
+
+        out: np.array or None
+            Preallocated float32 array of shape (len(paths), H, W) to write the stack into (e.g. a np.memmap)
+
+        **kwargs:
+            Other arguments of load_geotiff (block_rows, method, mask_nodata)
+
+    Output:
+        stack: np.array of shape (len(paths), H, W), float32
+            Downscaled climatic values of every file
+    '''
+    with rasterio.open(paths[0]) as src:
+        shape = (len(paths), src.height // kernel_size, src.width // kernel_size)
+    stack = np.empty(shape, dtype=np.float32) if out is None else out
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(load_geotiff, path, kernel_size, out=stack[i], **kwargs) for i, path in enumerate(paths)]
+        for future in futures:
+            future.result()
+
+    return stack
+
+
+def load_climate_stacks(data_folder, variables=('tmean', 'prec'), year=2013, kernel_size=10, max_workers=None, **kwargs):
+    ''' Load the monthly CHELSA files of several variables concurrently
+    
+    Input:
+        data_folder: str
+            Folder containing one subfolder per variable (see CHELSA_FOLDERS)
+
+        variables: iterable of str
+            Variables to load
+
+        year: int
+            Year of the timeseries
 
-    return data[0,0]
+        kernel_size: int
+            Downsampling factor
+
+        max_workers: int or None
+            Number of threads shared by all the files
+
+    Output:
+        stacks: dict
+            One (12, H, W) float32 stack per variable
+    '''
+    paths = {variable: chelsa_paths(data_folder, variable, year) for variable in variables}
+    with rasterio.open(paths[variables[0]][0]) as src:
+        shape = (12, src.height // kernel_size, src.width // kernel_size)
+    stacks = {variable: np.empty(shape, dtype=np.float32) for variable in variables}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(load_geotiff, path, kernel_size, out=stacks[variable][i], **kwargs)
+                   for variable in variables for i, path in enumerate(paths[variable])]
+        for future in futures:
+            future.result()
+
+    return stacks
+
+
+def _stack_metadata(paths, kernel_size, **kwargs):
+    ''' Describe how a downsampled stack is built, to detect stale caches '''
+    with rasterio.open(paths[0]) as src:
+        transform = src.transform * src.transform.scale(kernel_size, kernel_size)
+        shape = [len(paths), src.height // kernel_size, src.width // kernel_size]
+    # block_rows only changes how the stack is read, not its content
+    options = {key: kwargs[key] for key in sorted(kwargs) if key != 'block_rows'}
+    metadata = {
+        'sources': [os.path.abspath(path) for path in paths],
+        'mtimes': [os.path.getmtime(path) for path in paths],
+        'sizes': [os.path.getsize(path) for path in paths],
+        'kernel_size': kernel_size,
+        'options': options,
+        'transform': list(transform)[:6],
+        'shape': shape,
+        'dtype': 'float32',
+    }
+    # Round-trip through JSON so that it compares equal to the sidecar (tuples become lists, ...)
+    return json.loads(json.dumps(metadata))
+
+
+def load_cached_stack(paths, cache_file, kernel_size=10, max_workers=None, **kwargs):
+    ''' Load a downsampled stack of .tiff files from a memory-mapped .npy cache, building it if needed
+    
+    The stack is stored as cache_file (.npy) next to a .json sidecar recording the source files, their
+    modification times and sizes, the downsampling options and the transform of the downsampled grid.
+    The cache is rebuilt when any of these changes, otherwise it is opened with np.load(mmap_mode='r'),
+    which only maps the file and reads pages on demand.
+
+    Input:
+        paths: list of str
+            Paths to .tiff files with the same shape
+
+        cache_file: str
+            Path of the .npy cache (the sidecar is cache_file with a .json extension)
+
+        kernel_size: int
+            Downsampling factor
+
+        max_workers: int or None
+            Number of threads used to build the cache
+
+        **kwargs:
+            Other arguments of load_geotiff (block_rows, method, mask_nodata)
+
+    Output:
+        stack: np.memmap of shape (len(paths), H, W), float32, read-only
+            Downscaled climatic values of every file
+
+        metadata: dict
+            Content of the sidecar (the transform can be rebuilt with rasterio.Affine(*metadata['transform']))
+    '''
+    metadata = _stack_metadata(paths, kernel_size, **kwargs)
+    sidecar = os.path.splitext(cache_file)[0] + '.json'
+
+    if os.path.exists(cache_file) and os.path.exists(sidecar):
+        with open(sidecar) as f:
+            cached = json.load(f)
+        if cached == metadata:
+            return np.load(cache_file, mmap_mode='r'), metadata
+
+    # Build the stack directly into a temporary .npy file, then swap it in place
+    os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+    tmp_file = cache_file + '.tmp'
+    stack = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.float32, shape=tuple(metadata['shape']))
+    load_geotiff_stack(paths, kernel_size, max_workers=max_workers, out=stack, **kwargs)
+    stack.flush()
+    del stack
+    os.replace(tmp_file, cache_file)
+    with open(sidecar, 'w') as f:
+        json.dump(metadata, f, indent=1)
+
+    return np.load(cache_file, mmap_mode='r'), metadata
+
+
+def load_cached_climate_stacks(data_folder, cache_folder, variables=('tmean', 'prec'), year=2013, kernel_size=10, max_workers=None, **kwargs):
+    ''' Load the monthly CHELSA stacks of several variables through the memory-mapped cache
+    
+    Input:
+        data_folder: str
+            Folder containing one subfolder per variable (see CHELSA_FOLDERS)
+
+        cache_folder: str
+            Folder of the .npy caches and their .json sidecars
+
+        variables: iterable of str
+            Variables to load
+
+        year: int
+            Year of the timeseries
+
+        kernel_size: int
+            Downsampling factor
+
+    Output:
+        stacks: dict
+            One read-only (12, H, W) float32 memmap per variable (raw CHELSA values, not converted)
+    '''
+    stacks = {}
+    for variable in variables:
+        cache_file = os.path.join(cache_folder, f"CHELSA_{variable}_{year}_k{kernel_size}.npy")
+        stacks[variable], _ = load_cached_stack(chelsa_paths(data_folder, variable, year), cache_file,
+                                                kernel_size, max_workers=max_workers, **kwargs)
+    return stacks
 
 
 def interpolate_temp(data, map_gdf):
@@ -62,33 +303,296 @@ def interpolate_temp(data, map_gdf):
         mean_values: list
             interpolated mean climatic value per region of map_gdf
     """
+    zonal = region_zonal_stats(data.shape[-2:], map_gdf)
+    mean_values = list(zonal.stats(data, statistics=('mean',))['mean'][0])
+
+    return mean_values
+
+
+def region_zonal_stats(grid_shape, map_gdf):
+    ''' Zonal statistics engine of the regions of a GeoDataFrame on the global WGS84 grid of the climatic data.
+    
+    Every region is rasterized once, inside the window of its bounds, into the flat indices of its pixels; the
+    engine is cached per set of geometries and grid (see raster_utils.ZonalStats).
+
+    Input:
+        grid_shape: tuple (H, W)
+            Shape of the climatic data grid
+
+        map_gdf: gpd.GeoDataFrame
+            Contains geometries of regions or countries
+
+    Output:
+        zonal: raster_utils.ZonalStats
+            zonal.stats(stack) gives count, sum, mean, std, min and max per band and per region
+    '''
     # Define pixel size and transformation for WGS84
-    pixel_size = 360 / data.shape[1]  # Calculate pixel size dynamically based on array dimensions
+    pixel_size = 360 / grid_shape[1]  # Calculate pixel size dynamically based on array dimensions
     transform = from_origin(-180, 90, pixel_size, pixel_size)
 
-    mean_values = []
+    return ZonalStats.from_geometries(map_gdf.geometry.values, grid_shape, transform)
 
-    # Loop through each country and compute the mean temperature
-    for _, country in map_gdf.iterrows():
-        # Convert country geometry to GeoJSON format
-        geom = [country['geometry'].__geo_interface__]
+# Conversion (scale, offset) of the raw CHELSA values to physical units: tmean is stored in 1/10 K
+CHELSA_CONVERSIONS = {'tmean': (0.1, -273.15)}
 
-        # Create a mask for the current country geometry
-        mask = geometry_mask(
-            geometries=geom,
-            out_shape=data.shape,
-            transform=transform,
-            invert=True  # True where the geometry is located
-        )
 
-        # Apply mask to the temperature data
-        masked_data = np.where(mask, data, np.nan)
+def _tile_windows(geometries, transform, grid_shape, max_gap=10):
+    ''' Pixel windows covering the parts of the regions of one tile.
+
+    The parts of the geometries are grouped by longitude, and a new group starts after a gap of more than
+    max_gap degrees, so that a region crossing the antimeridian (parts near -180 and +180) gets two narrow
+    windows rather than one window spanning the whole width of the grid.
+    '''
+    parts = shapely.get_parts(np.asarray(geometries, dtype=object))
+    bounds = shapely.bounds(parts)
+    bounds = bounds[~np.isnan(bounds).any(axis=1)]
+    if not len(bounds):
+        return []
+    bounds = bounds[np.argsort(bounds[:, 0], kind='stable')]
+    reach = np.maximum.accumulate(bounds[:, 2])
+    groups = np.concatenate([[0], np.cumsum(bounds[1:, 0] > reach[:-1] + max_gap)])
+
+    windows = []
+    for group in np.unique(groups):
+        group_bounds = bounds[groups == group]
+        window = geometry_window(box(*group_bounds[:, :2].min(axis=0), *group_bounds[:, 2:].max(axis=0)), transform, grid_shape)
+        if window is not None:
+            windows.append(window)
+    return windows
+
+
+def _climate_tile_worker(geometries, files, statistics, conversions):
+    ''' Zonal statistics of the regions of one tile for every (variable, month) file, reading only the tile windows '''
+    with rasterio.open(files[0][2]) as src:
+        transform, grid_shape = src.transform, (src.height, src.width)
+
+    # Regions without any pixel keep a count of 0 (NaN would not survive the cast to int64)
+    results = {name: np.zeros((len(files), len(geometries)), dtype=np.int64) if name == 'count'
+               else np.full((len(files), len(geometries)), np.nan) for name in statistics}
+    windows = _tile_windows(geometries, transform, grid_shape)
+    if not windows:
+        return results
+
+    # Pixels of the regions in every window, as flat indices in the concatenation of the windows
+    pixels, pixel_labels, size = [], [], 0
+    for window in windows:
+        zonal = ZonalStats.from_geometries(geometries, (window.height, window.width), window_transform(window, transform))
+        pixels.append(zonal.pixels + size)
+        pixel_labels.append(zonal.pixel_labels)
+        size += window.height * window.width
+    pixels, pixel_labels = np.concatenate(pixels), np.concatenate(pixel_labels)
+    order = np.argsort(pixel_labels, kind='stable')
+    zonal = ZonalStats(pixels[order], pixel_labels[order], len(geometries), (1, size))
+
+    for i, (variable, _, path) in enumerate(files):
+        with rasterio.open(path) as src:
+            data = np.concatenate([src.read(1, window=window).ravel() for window in windows]).astype(np.float64)
+            if src.nodata is not None:
+                data[(np.isnan(data) if np.isnan(src.nodata) else data == src.nodata)] = np.nan
+        scale, offset = conversions.get(variable, (1, 0))
+        if scale != 1 or offset != 0:
+            data = data * scale + offset
+        for name, values in zonal.stats(data[None], statistics).items():
+            results[name][i] = values[0]
+
+    return results
+
+
+def regional_climate_statistics(regions, files, statistics=('count', 'mean', 'std', 'min', 'max'), tile_degrees=30,
+                                conversions=CHELSA_CONVERSIONS, n_jobs=None, region_column=None):
+    ''' Monthly climate statistics of every region of a GeoDataFrame, at the full resolution of the rasters.
+    
+    The globe is cut in tiles of tile_degrees x tile_degrees, each region is assigned to the tile of its
+    representative point, and the tiles are processed in a process pool. A worker only reads the pixel windows
+    covering its regions from every file (see _tile_windows), so memory stays bounded by the tile size rather
+    than by the globe.
 
-        # Calculate the mean temperature for the country, ignoring NaNs
-        mean = np.nanmean(masked_data)
-        mean_values.append(mean)
+    Input:
+        regions: gpd.GeoDataFrame
+            Region geometries in WGS84 (e.g. ne_50m_admin_1_states_provinces)
+
+        files: dict
+            Paths of the 12 monthly rasters of every variable, e.g. {v: chelsa_paths(DATA_FOLDER, v) for v in ('tmean', 'prec')}
+
+        statistics: iterable of str
+            Among 'count', 'sum', 'mean', 'std', 'min', 'max'
+
+        tile_degrees: float
+            Size of the tiles in degrees
+
+        conversions: dict
+            (scale, offset) applied to the raw values of a variable before computing statistics
+
+        n_jobs: int or None
+            Number of worker processes (default: number of CPUs)
+
+        region_column: str or None
+            Column identifying the regions in the output (default: index of regions)
+
+    Output:
+        climate_df: pd.DataFrame
+            Tidy table with one row per (region, month, variable) and one column per statistic
+    '''
+    statistics = tuple(statistics)
+    file_list = [(variable, month, path) for variable, paths in files.items() for month, path in enumerate(paths, start=1)]
+    region_ids = regions.index.to_numpy() if region_column is None else regions[region_column].to_numpy()
+
+    # Assign every region to the tile containing its representative point
+    geometries = regions.geometry.values
+    points = regions.geometry.representative_point()
+    tile_x = np.floor((points.x.to_numpy() + 180) / tile_degrees).astype(np.int64)
+    tile_y = np.floor((90 - points.y.to_numpy()) / tile_degrees).astype(np.int64)
+    valid = ~(regions.geometry.isna().to_numpy() | regions.geometry.is_empty.to_numpy())
+    tiles = pd.Series(np.flatnonzero(valid)).groupby([tile_y[valid], tile_x[valid]]).agg(list).tolist()
+
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        futures = [executor.submit(_climate_tile_worker, list(geometries[tile]), file_list, statistics, conversions)
+                   for tile in tiles]
+        tile_results = [future.result() for future in futures]
+
+    # Tidy table: region-major, then variable and month in the order of files
+    n_files = len(file_list)
+    frames = []
+    for tile, results in zip(tiles, tile_results):
+        frame = pd.DataFrame({
+            'region': np.repeat(region_ids[tile], n_files),
+            'variable': np.tile([variable for variable, _, _ in file_list], len(tile)),
+            'month': np.tile(np.array([month for _, month, _ in file_list], dtype=np.int8), len(tile)),
+        })
+        for name in statistics:
+            frame[name] = results[name].T.ravel().astype(np.int64 if name == 'count' else np.float32)
+        frames.append(frame)
+
+    columns = ['region', 'variable', 'month', *statistics]
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    climate_df = pd.concat(frames, ignore_index=True)
+    climate_df['variable'] = climate_df['variable'].astype('category')
+    return climate_df[columns]
+
+
+def compute_climatology(data_folder, output_folder, variable, years=range(1979, 2014), kernel_size=10, block_rows=256,
+                        conversions=CHELSA_CONVERSIONS):
+    ''' Per-pixel mean and standard deviation of every calendar month over several years, computed out of core.
+    
+    For every calendar month, the rasters of all the years are streamed in blocks of rows: each block is read
+    from every year, optionally downsampled, and folded into running (Welford) count, mean and M2 arrays, so
+    memory is bounded by one block of rows whatever the number of years and the resolution. The results are
+    written into memory-mapped .npy stacks of shape (12, H, W) next to a .json sidecar.
+
+    The outputs take 12 * (4 + 4 + 2) = 120 bytes per output pixel and per variable: about 1.1 GB on the grid
+    of the clustering (kernel_size=10, 2088 x 4320), but about 108 GB at the full CHELSA resolution (kernel_size=1,
+    20880 x 43200).
+
+    Input:
+        data_folder: str
+            Folder containing one subfolder per variable (see CHELSA_FOLDERS)
+
+        output_folder: str
+            Folder of the output stacks {variable}_climatology_{mean,std,count}.npy
+
+        variable: str
+            'tmean' or 'prec'
+
+        years: iterable of int
+            Years of the climatology
+
+        kernel_size: int
+            Downsampling factor (default: 10, the resolution of the clustering; 1 for the full resolution)
+
+        block_rows: int
+            Number of output rows processed at once
+
+        conversions: dict
+            (scale, offset) applied to the raw values of a variable (e.g. tmean to degrees C)
+
+    Output:
+        climatology: dict
+            Read-only memmaps 'mean', 'std' (float32, NaN without data) and 'count' (int16, number of valid years)
+    '''
+    years = list(years)
+    scale, offset = conversions.get(variable, (1, 0))
+    paths = {year: chelsa_paths(data_folder, variable, year) for year in years}
+
+    with rasterio.open(paths[years[0]][0]) as src:
+        height, width = src.height // kernel_size, src.width // kernel_size
+        transform = src.transform * src.transform.scale(kernel_size, kernel_size)
+        source_width = width * kernel_size
+
+    os.makedirs(output_folder, exist_ok=True)
+    files = {name: os.path.join(output_folder, f"{variable}_climatology_{name}.npy") for name in ('mean', 'std', 'count')}
+    mean_out = np.lib.format.open_memmap(files['mean'] + '.tmp', mode='w+', dtype=np.float32, shape=(12, height, width))
+    std_out = np.lib.format.open_memmap(files['std'] + '.tmp', mode='w+', dtype=np.float32, shape=(12, height, width))
+    count_out = np.lib.format.open_memmap(files['count'] + '.tmp', mode='w+', dtype=np.int16, shape=(12, height, width))
+
+    for month in range(12):
+        datasets = [rasterio.open(paths[year][month]) for year in years]
+        try:
+            for start in range(0, height, block_rows):
+                stop = min(start + block_rows, height)
+                window = Window(0, start * kernel_size, source_width, (stop - start) * kernel_size)
+
+                count = np.zeros((stop - start, width), dtype=np.int32)
+                mean = np.zeros((stop - start, width), dtype=np.float64)
+                m2 = np.zeros((stop - start, width), dtype=np.float64)
+
+                for src in datasets:
+                    block = src.read(1, window=window)
+                    if kernel_size > 1:
+                        values = downsample(block, kernel_size, nodata=src.nodata).astype(np.float64)
+                    else:
+                        values = block.astype(np.float64)
+                        if src.nodata is not None:
+                            values[(np.isnan(values) if np.isnan(src.nodata) else values == src.nodata)] = np.nan
+                    values = values * scale + offset
+
+                    # Welford update of the pixels with a valid value this year
+                    valid = np.isfinite(values)
+                    count += valid
+                    delta = np.where(valid, values - mean, 0)
+                    mean += delta / np.maximum(count, 1)
+                    m2 += delta * np.where(valid, values - mean, 0)
+
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    mean_out[month, start:stop] = np.where(count > 0, mean, np.nan)
+                    std_out[month, start:stop] = np.where(count > 0, np.sqrt(m2 / count), np.nan)
+                count_out[month, start:stop] = count
+        finally:
+            for src in datasets:
+                src.close()
+
+    # Close the memmaps, then swap the finished stacks in place
+    for out in (mean_out, std_out, count_out):
+        out.flush()
+    del mean_out, std_out, count_out
+    for name in files:
+        os.replace(files[name] + '.tmp', files[name])
+
+    metadata = {
+        'variable': variable,
+        'years': years,
+        'sources': [os.path.abspath(path) for year in years for path in paths[year]],
+        'kernel_size': kernel_size,
+        'conversion': [scale, offset],
+        'transform': list(transform)[:6],
+        'shape': [12, height, width],
+    }
+    with open(os.path.join(output_folder, f"{variable}_climatology.json"), 'w') as f:
+        json.dump(metadata, f, indent=1)
+
+    return load_climatology(output_folder, variable)
+
+
+def load_climatology(output_folder, variable):
+    ''' Open the climatology stacks written by compute_climatology as read-only memmaps
+    
+    Output:
+        climatology: dict
+            'mean', 'std' and 'count' stacks of shape (12, H, W)
+    '''
+    return {name: np.load(os.path.join(output_folder, f"{variable}_climatology_{name}.npy"), mmap_mode='r')
+            for name in ('mean', 'std', 'count')}
 
-    return mean_values
 
 def generate_usgdfs(us, tmean_data, prec_data):
     ''' 
@@ -106,16 +610,10 @@ def generate_usgdfs(us, tmean_data, prec_data):
     
     '''
 
-    t_stats = np.zeros((12, 49))
-    p_stats = np.zeros((12, 49))
-
-    # Append a gdf per month in the list us_gdfs
-    # Standardize the temperature and precipitation data
-    for i in range(12):
-        t_stat = interpolate_temp(tmean_data[i,:,:], us)
-        p_stat = interpolate_temp(prec_data[i,:,:], us)
-        t_stats[i] = t_stat #(t_stat - us_mean_temp) / us_std_temp
-        p_stats[i] = p_stat #(p_stat - us_mean_prec) / us_std_prec
+    # Mean of every month and every state, in one pass per variable over the state pixels rasterized once for both
+    zonal = region_zonal_stats(tmean_data.shape[-2:], us)
+    t_stats = zonal.stats(tmean_data, statistics=('mean',))['mean']
+    p_stats = zonal.stats(prec_data, statistics=('mean',))['mean']
 
     # Normalize temperature and precipitation data
     av_tmean_states = np.mean(t_stats)
@@ -135,7 +633,219 @@ def generate_usgdfs(us, tmean_data, prec_data):
     return us_gdfs, t_stats, p_stats
 
 
-def plot_usa(us_gdfs, variable):
+# Simplified layers and dissolved cluster unions already computed, keyed by geometries and tolerance
+_GEOMETRY_CACHE = OrderedDict()
+_GEOMETRY_CACHE_SIZE = 32
+
+
+def _cache_geometries(key, compute):
+    ''' Return the cached result for key, computing and storing it if needed '''
+    if key in _GEOMETRY_CACHE:
+        _GEOMETRY_CACHE.move_to_end(key)
+        return _GEOMETRY_CACHE[key]
+    result = compute()
+    _GEOMETRY_CACHE[key] = result
+    if len(_GEOMETRY_CACHE) > _GEOMETRY_CACHE_SIZE:
+        _GEOMETRY_CACHE.popitem(last=False)
+    return result
+
+
+def _simplify(geometries, tolerance):
+    ''' Topology-preserving simplification: when the polygons form a valid coverage (shared borders with
+    identical vertices), shared borders are simplified once with coverage_simplify (shapely >= 2.1, GEOS >= 3.12),
+    so neighbours never gap or overlap; otherwise each polygon is simplified with preserve_topology '''
+    geometries = np.asarray(geometries, dtype=object)
+    out = geometries.copy()
+    polygonal = np.array([g is not None and not g.is_empty and g.geom_type in ('Polygon', 'MultiPolygon') for g in geometries], dtype=bool)
+    polygons = geometries[polygonal]
+    try:
+        coverage = hasattr(shapely, 'coverage_simplify') and bool(shapely.coverage_is_valid(polygons))
+    except (AttributeError, shapely.errors.GEOSException, shapely.errors.UnsupportedGEOSVersionError):
+        coverage = False
+    if coverage:
+        out[polygonal] = shapely.coverage_simplify(polygons, tolerance)
+    else:
+        out[polygonal] = shapely.simplify(polygons, tolerance, preserve_topology=True)
+    return out
+
+
+def simplify_geometries(gdf, tolerance):
+    ''' Copy of a GeoDataFrame with simplified geometries, cached per set of geometries and tolerance.
+    
+    Input:
+        gdf: gpd.GeoDataFrame
+            Layer to simplify (e.g. world countries or admin-1 regions)
+
+        tolerance: float or None
+            Simplification tolerance in the units of the layer (degrees for WGS84); None keeps the full detail
+
+    Output:
+        simple_gdf: gpd.GeoDataFrame
+    '''
+    if not tolerance:
+        return gdf
+    geometries = gdf.geometry.values
+    key = ('simplify', geometry_digest(geometries), tolerance)
+    simplified = _cache_geometries(key, lambda: _simplify(geometries, tolerance))
+
+    simple_gdf = gdf.copy()
+    simple_gdf[gdf.geometry.name] = gpd.GeoSeries(simplified, index=gdf.index, crs=gdf.crs)
+    return simple_gdf
+
+
+def cluster_unions(gdf, labels, tolerance=None):
+    ''' Dissolved geometry of every label, cached per set of geometries, label assignment and tolerance.
+    
+    Input:
+        gdf: gpd.GeoDataFrame
+            Regions (e.g. US states)
+
+        labels: array-like
+            Label of every region (e.g. us['labels'])
+
+        tolerance: float or None
+            Simplification tolerance applied to the regions before the union
+
+    Output:
+        unions_gdf: gpd.GeoDataFrame
+            One row per label, with columns 'labels' and 'geometry'
+    '''
+    labels = np.asarray(labels)
+    geometries = simplify_geometries(gdf, tolerance).geometry.values
+    key = ('union', geometry_digest(gdf.geometry.values), pd.util.hash_array(labels.astype(object)).tobytes(), tolerance)
+
+    def compute():
+        codes, uniques = pd.factorize(labels, sort=True)
+        unions = [shapely.union_all(np.asarray(geometries, dtype=object)[codes == k]) for k in range(len(uniques))]
+        return uniques, unions
+
+    uniques, unions = _cache_geometries(key, compute)
+    return gpd.GeoDataFrame({'labels': uniques}, geometry=list(unions), crs=gdf.crs)
+
+
+def _geometry_path(geometry):
+    ''' Compound matplotlib Path of a (Multi)Polygon: exterior and holes of every part '''
+    if geometry is None or geometry.is_empty:
+        return Path(np.empty((0, 2)))
+    polygons = geometry.geoms if hasattr(geometry, 'geoms') else [geometry]
+    rings = [Path(np.asarray(ring.coords)[:, :2], closed=True)
+             for polygon in polygons if polygon.geom_type == 'Polygon'
+             for ring in (polygon.exterior, *polygon.interiors)]
+    return Path.make_compound_path(*rings) if rings else Path(np.empty((0, 2)))
+
+
+class ChoroplethRenderer:
+    ''' Choropleth maps of one set of regions with many color arrays (months, variables, animation frames).
+    
+    The matplotlib paths of the (simplified) geometries are built once; every panel reuses them in a
+    PatchCollection, and changing the data of a panel or a frame only calls set_array on the collection,
+    instead of rebuilding the patches with GeoDataFrame.plot each time.
+
+    Input:
+        gdf: gpd.GeoDataFrame
+            Regions to draw (e.g. US states), in the order of the values
+
+        tolerance: float or None
+            Simplification tolerance of the geometries in degrees (None for the full detail)
+
+        cmap: str
+            Colormap
+
+        missing_color: str
+            Color of the regions with a missing (NaN) value
+
+        edgecolor, linewidth:
+            Style of the borders
+    '''
+
+    def __init__(self, gdf, tolerance=0.01, cmap='seismic', missing_color='lightgrey', edgecolor='face', linewidth=0.2):
+        simple_gdf = simplify_geometries(gdf, tolerance)
+        self.paths = [_geometry_path(geometry) for geometry in simple_gdf.geometry.values]
+        self.bounds = simple_gdf.total_bounds
+        self.geographic = gdf.crs is None or gdf.crs.is_geographic
+        self.cmap = plt.get_cmap(cmap).with_extremes(bad=missing_color)
+        self.edgecolor = edgecolor
+        self.linewidth = linewidth
+
+    def draw(self, ax, values, vmin=None, vmax=None):
+        ''' Draw the regions on an axis, colored by values.
+        
+        Input:
+            ax: matplotlib axis
+
+            values: np.array of shape (n_regions,)
+                Value of every region (NaN for missing)
+
+            vmin, vmax: float or None
+                Range of the colormap
+
+        Output:
+            collection: matplotlib.collections.PatchCollection
+                Collection to pass to update (or to fig.colorbar)
+        '''
+        collection = PatchCollection([PathPatch(path) for path in self.paths], cmap=self.cmap,
+                                     norm=Normalize(vmin=vmin, vmax=vmax), edgecolor=self.edgecolor, linewidth=self.linewidth)
+        self.update(collection, values)
+        ax.add_collection(collection, autolim=False)
+
+        minx, miny, maxx, maxy = self.bounds
+        ax.set_xlim(minx, maxx)
+        ax.set_ylim(miny, maxy)
+        # Same aspect as GeoDataFrame.plot for geographic coordinates
+        ax.set_aspect(1 / np.cos(np.deg2rad((miny + maxy) / 2)) if self.geographic else 'equal')
+        return collection
+
+    @staticmethod
+    def update(collection, values):
+        ''' Recolor a drawn collection with new values, without rebuilding its patches '''
+        values = np.asarray(values, dtype=np.float64)
+        collection.set_array(np.ma.masked_invalid(values))
+        return collection
+
+    def animate(self, frames, titles=None, vmin=None, vmax=None, label=None, interval=500, figsize=(10, 6)):
+        ''' Animation of the regions over several frames of values (e.g. 12 months), redrawn with blitting.
+        
+        Input:
+            frames: np.array of shape (n_frames, n_regions)
+                Values of every region in every frame
+
+            titles: list of str or None
+                Title of every frame
+
+            vmin, vmax: float or None
+                Range of the colormap (default: range of all the frames)
+
+            label: str or None
+                Label of the colorbar
+
+            interval: int
+                Delay between frames in milliseconds
+
+        Output:
+            animation: matplotlib.animation.FuncAnimation
+        '''
+        frames = np.asarray(frames, dtype=np.float64)
+        vmin = np.nanmin(frames) if vmin is None else vmin
+        vmax = np.nanmax(frames) if vmax is None else vmax
+
+        fig, ax = plt.subplots(figsize=figsize)
+        collection = self.draw(ax, frames[0], vmin, vmax)
+        collection.set_animated(True)
+        fig.colorbar(collection, ax=ax, orientation='horizontal', label=label)
+        ax.axis('off')
+        title = ax.text(0.5, 1.02, titles[0] if titles else '', transform=ax.transAxes, ha='center', fontsize=14, animated=True)
+
+        def update(i):
+            self.update(collection, frames[i])
+            title.set_text(titles[i] if titles else '')
+            return collection, title
+
+        animation = FuncAnimation(fig, update, frames=len(frames), interval=interval, blit=True)
+        plt.close(fig)
+        return animation
+
+
+def plot_usa(us_gdfs, variable, tolerance=0.01):
     ''' Plots a map of a given climatic variable in the USA.
     
     Input: 
@@ -144,6 +854,9 @@ def plot_usa(us_gdfs, variable):
         
         variable: str
             Specifies the unit of the axis
+
+        tolerance: float or None
+            Simplification tolerance of the state geometries in degrees (None for the full detail)
             
     '''
     
@@ -161,20 +874,16 @@ def plot_usa(us_gdfs, variable):
     axs = axs.ravel()
 
     all = [gdf[variable].values for gdf in us_gdfs]
-    vmin = min([value.min() for value in all])
-    vmax = max([value.max() for value in all])
+    vmin = min([np.nanmin(value) for value in all])
+    vmax = max([np.nanmax(value) for value in all])
+
+    # The state paths are built once, every month only changes the colors
+    renderer = ChoroplethRenderer(us_gdfs[0], tolerance=tolerance, cmap='seismic')
 
     # normalize all data!!
     for i, ax in enumerate(axs):
-        # im = axs[i].imshow(temp_data[i], cmap='hot')  # Initialize with the first frame
-        # cbar = plt.colorbar(im, ax=axs[i])
-        # cbar.set_label('Color Intensity')  # Optionally, add a label to the colorbar
-
-
-        us_gdfs[i].plot(column=variable, ax=ax, legend=True, cmap='seismic', vmin=vmin, vmax=vmax,
-                        legend_kwds={'label': f"Average {name}",
-                                    'orientation': 'horizontal'},
-                        missing_kwds={'color': 'lightgrey'})
+        collection = renderer.draw(ax, all[i], vmin=vmin, vmax=vmax)
+        fig.colorbar(collection, ax=ax, orientation='horizontal', label=f"Average {name}")
         ax.set_title(f'{months[i]}')
         ax.axis('off')  # Turn off the axis 
 
@@ -183,6 +892,37 @@ def plot_usa(us_gdfs, variable):
     plt.show()
 
 
+def animate_usa(us_gdfs, variable, tolerance=0.01, interval=500):
+    ''' Animation of a given climatic variable in the USA over the 12 months.
+    
+    Input: 
+        us_gdfs: list of gpd.GeoDataFrame
+            Contains monthly climatic data and geometries of USA states
+        
+        variable: str
+            'tmean' or 'prec'
+
+        tolerance: float or None
+            Simplification tolerance of the state geometries in degrees
+
+        interval: int
+            Delay between months in milliseconds
+
+    Output:
+        html: IPython.display.HTML
+            Animation to display in a notebook
+    '''
+    months = ['January', 'February', 'March', 'April', 'May', 'June',
+                  'July', 'August', 'September', 'October', 'November', 'December']
+    name = {'tmean': 'mean temperature', 'prec': 'precipitation'}.get(variable, variable)
+
+    renderer = ChoroplethRenderer(us_gdfs[0], tolerance=tolerance, cmap='seismic')
+    frames = np.stack([gdf[variable].to_numpy(dtype=np.float64) for gdf in us_gdfs])
+    animation = renderer.animate(frames, titles=[f"{name.capitalize()} in {month}" for month in months],
+                                 label=f"Average {name}", interval=interval)
+    return HTML(animation.to_jshtml())
+
+
 def generate_geodf(df, world):
     ''' Generate a GeoDataFrame with national information on beer preferences (average ratings, ...)
     and geometry information about the country, as to be able to generate world map of different beer-related
@@ -255,14 +995,18 @@ def generate_geodf(df, world):
 
     return geo_df
 
-def plot_geodf(geo_df):
+def plot_geodf(geo_df, tolerance=0.05):
     ''' Plot national beer preferences statistics on a world map
     
     Input:
         geo_df: gpd.GeoDataFrame
             Contains geometries of all countries and data about national beer preferences
+
+        tolerance: float or None
+            Simplification tolerance of the country geometries in degrees (None for the full detail)
             
     '''
+    geo_df = simplify_geometries(geo_df, tolerance)
 
     fig, ax = plt.subplots(1, 2, figsize=(20, 6))
 
@@ -298,8 +1042,54 @@ def get_season(date):
     else:
         return 4
 
-def get_top_styles_per_season(df):
-    return df.groupby('season_num').apply(lambda x: x.nlargest(5, 'rating').sort_values(by='season_num', ascending=True)).reset_index(drop=True)
+# Season label of every month (index 0 is unused): 1 winter, 2 spring, 3 summer, 4 fall
+SEASON_OF_MONTH = np.array([0, 1, 1, 2, 2, 2, 3, 3, 3, 4, 4, 4, 1], dtype=np.int8)
+
+
+def get_seasons(dates):
+    ''' Map datetime64 values to season labels at once, through a month -> season lookup table
+    
+    Input:
+        dates: pd.Series or array-like of datetime64
+
+    Output:
+        labels: pd.Series of int8 (same labels as get_season, 0 for missing dates), aligned on dates if it is a Series
+    '''
+    index = dates.index if isinstance(dates, pd.Series) else None
+    months = pd.DatetimeIndex(pd.to_datetime(np.asarray(dates))).month.to_numpy(dtype=np.float64, na_value=0)
+    return pd.Series(SEASON_OF_MONTH[months.astype(np.int64)], index=index, name='season_num')
+
+
+def top_k_per_group(df, group_column, value_column, k=5):
+    ''' Rows with the k largest values of every group, with one stable sort instead of one nlargest call per group
+    
+    Same result as df.groupby(group_column).apply(lambda x: x.nlargest(k, value_column)).reset_index(drop=True):
+    groups in ascending order, values in descending order, ties in the order of the rows. Missing values are always
+    dropped, whereas nlargest appends them to groups with fewer than k values.
+
+    Input:
+        df: pd.DataFrame
+
+        group_column, value_column: str
+
+        k: int
+
+    Output:
+        top_df: pd.DataFrame
+    '''
+    df = df[df[group_column].notna() & df[value_column].notna()]
+
+    # Sort by group, then by decreasing value (lexsort is stable, so ties keep the order of the rows)
+    group_codes = pd.factorize(df[group_column], sort=True)[0]
+    order = np.lexsort((-df[value_column].to_numpy(), group_codes))
+    top_df = df.iloc[order]
+
+    # Rank of every row in its group, keep the first k
+    return top_df[top_df.groupby(group_column, sort=False).cumcount().to_numpy() < k].reset_index(drop=True)
+
+
+def get_top_styles_per_season(df, k=5):
+    return top_k_per_group(df, 'season_num', 'rating', k)
     
 def get_season_name(season_num):
     if season_num == 1:
@@ -376,11 +1166,11 @@ def find_coordinates(data, us):
             Gdf containing the geometry of the country of interest, with the coordinate system WGS84
 
     Output:
-        us_pixel_indices: list
-            Indices of the array that belongs to the country in us.
+        us_pixel_indices: np.array of shape (n_pixels, 2)
+            Indices (row, col) of the array that belongs to the country in us.
         
-        us_pixel_coords: 
-            Coordinates of each point of the array that belongs to the country is us.
+        us_pixel_coords: np.array of shape (n_pixels, 2)
+            Coordinates (lon, lat) of each point of the array that belongs to the country is us.
 
         inverse_transform: rasterio object
             inverse coordinate transform.
@@ -397,22 +1187,102 @@ def find_coordinates(data, us):
     us_geometries = [shape(geom.__geo_interface__) for geom in us["geometry"].values]
     us_union_geometry = unary_union(us_geometries)
 
-    us_mask = geometry_mask(
-        geometries=[us_union_geometry],
-        out_shape=data.shape,
-        transform=transform,
-        invert=True  # True where the geometry is located
-    )
-
-    # Find indices of pixels where the `us_mask` is True
-    us_pixel_indices = np.argwhere(us_mask)
+    # Rasterize the union only inside the pixel window of its bounds, and find the indices of its pixels
+    rows, cols = geometry_pixels(us_union_geometry, transform, data.shape[-2:])
+    us_pixel_indices = np.column_stack((rows, cols))
 
     # Convert indices to geographic coordinates
-    us_pixel_coords = [(transform * (col, row)) for row, col in us_pixel_indices]
+    us_pixel_coords = pixel_coordinates(rows, cols, transform)
 
     return us_pixel_indices, us_pixel_coords, inverse_transform
 
 
+def pixel_coordinates(rows, cols, transform):
+    ''' Apply an affine transform to whole arrays of pixel indices.
+    
+    Input:
+        rows, cols: np.array of int
+            Pixel indices
+
+        transform: affine.Affine
+            Transform of the grid
+
+    Output:
+        coords: np.array of shape (n_pixels, 2)
+            Coordinates (x, y) of the upper-left corner of every pixel, same as transform * (col, row)
+    '''
+    a, b, c, d, e, f = tuple(transform)[:6]
+    cols, rows = np.asarray(cols, dtype=np.float64), np.asarray(rows, dtype=np.float64)
+    return np.column_stack((a * cols + b * rows + c, d * cols + e * rows + f))
+
+
+def extract_region_features(regions, stacks, scalers=None, region_column=None, dtype=np.float32):
+    ''' Generates the clustering features of every pixel of several regions in one batched call.
+    
+    The pixels of every region are found once (rasterized inside the window of each geometry, and cached),
+    their monthly values are gathered from every stack with one fancy-index, and the features are standardized
+    with the given scalers, or with scalers fitted on all the requested regions.
+
+    Input:
+        regions: gpd.GeoDataFrame
+            Geometries of the regions of interest, in WGS84
+
+        stacks: dict
+            Monthly climatic data of shape (12, H, W) per variable on the global WGS84 grid, e.g. {'tmean': tmean_data, 'prec': prec_data}
+
+        scalers: dict or None
+            Fitted StandardScaler per variable (e.g. from a previous call); fitted on these regions if None
+
+        region_column: str or None
+            Column identifying the regions in the output (default: index of regions)
+
+        dtype: np.dtype
+            Dtype of the feature columns (lat and lon are always float64)
+
+    Output:
+        features_df: pd.DataFrame
+            One row per pixel with valid data: region_id, row and col of the pixel in the grid, lat and lon of its
+            upper-left corner, and 12 standardized monthly values per variable (tmean_1, prec_1, ..., tmean_12, prec_12)
+
+        scalers: dict
+            StandardScaler per variable
+    '''
+    variables = list(stacks)
+    grid_shape = stacks[variables[0]].shape[-2:]
+
+    # Define pixel size and transformation for WGS84
+    pixel_size = 360 / grid_shape[1]
+    transform = from_origin(-180, 90, pixel_size, pixel_size)
+
+    zonal = ZonalStats.from_geometries(regions.geometry.values, grid_shape, transform)
+    region_ids = regions.index.to_numpy() if region_column is None else regions[region_column].to_numpy()
+
+    # Gather the 12 monthly values of every pixel at once, and drop pixels without climatic data (NaN)
+    values = {variable: zonal.values(stacks[variable]).T for variable in variables}
+    valid = np.logical_and.reduce([np.isfinite(values[variable]).all(axis=1) for variable in variables])
+    pixels, pixel_labels = zonal.pixels[valid], zonal.pixel_labels[valid]
+
+    if scalers is None:
+        scalers = {variable: StandardScaler().fit(values[variable][valid]) for variable in variables}
+
+    features = np.empty((len(pixels), 12 * len(variables)), dtype=dtype)
+    for k, variable in enumerate(variables):
+        features[:, k::len(variables)] = scalers[variable].transform(values[variable][valid])
+    columns = [f"{variable}_{month}" for month in range(1, 13) for variable in variables]
+
+    # Coordinates stay float64 (float32 is too coarse to map them back to pixels), next to the exact pixel indices
+    rows, cols = pixels // grid_shape[1], pixels % grid_shape[1]
+    coords = pixel_coordinates(rows, cols, transform)
+    features_df = pd.DataFrame(features, columns=columns)
+    features_df.insert(0, 'lon', coords[:, 0])
+    features_df.insert(0, 'lat', coords[:, 1])
+    features_df.insert(0, 'col', cols)
+    features_df.insert(0, 'row', rows)
+    features_df.insert(0, 'region_id', region_ids[pixel_labels])
+
+    return features_df, scalers
+
+
 def data_preparation(tmean_data, prec_data, us):
     ''' Generates a dataframe contining necessary features for clustering.
     
@@ -429,7 +1299,7 @@ def data_preparation(tmean_data, prec_data, us):
     Output:
         us_df: pd.DataFrame
             Df containing the features necessary for clustering (12 normalised monthly values for temperature and precipitation)
-            and the geographical coordinates of each point (lat, lon)
+            and the geographical coordinates of each point (lat, lon), with its pixel indices in the grid (row, col)
 
         tmean_scaler:  scipy.StandardScaler() object
             Scaler for temperature data
@@ -439,82 +1309,100 @@ def data_preparation(tmean_data, prec_data, us):
     
     '''
 
-    us_pixel_indices, us_pixel_coords, inverse_transform = find_coordinates(tmean_data[0], us)
-    
-    lon = [x[0] for x in us_pixel_coords]
-    lat = [x[1] for x in us_pixel_coords]
-    us_df = pd.DataFrame({"lat": lat, "lon": lon})
+    # All the regions of us as a single region
+    union = gpd.GeoDataFrame(geometry=[unary_union(us.geometry.values)], crs=us.crs)
+    us_df, scalers = extract_region_features(union, {'tmean': tmean_data, 'prec': prec_data}, dtype=np.float64)
+    us_df = us_df.drop(columns='region_id')
+    tmean_scaler, prec_scaler = scalers['tmean'], scalers['prec']
+
+    return us_df, tmean_scaler, prec_scaler
+
+def swiss_data_preparation(tmean_data, prec_data, switzerland, tmean_scaler, prec_scaler):
+
+    # All the regions of switzerland as a single region, standardized with the scalers fitted on the US
+    union = gpd.GeoDataFrame(geometry=[unary_union(switzerland.geometry.values)], crs=switzerland.crs)
+    ch_df, _ = extract_region_features(union, {'tmean': tmean_data, 'prec': prec_data},
+                                       scalers={'tmean': tmean_scaler, 'prec': prec_scaler}, dtype=np.float64)
+    ch_df = ch_df.drop(columns='region_id')
 
-    lon_idx = [x[0] for x in us_pixel_indices]
-    lat_idx = [x[1] for x in us_pixel_indices]
+    return ch_df
 
-    # standardize data
-    tmean_us = np.zeros((len(lat), 12)) 
-    prec_us = np.zeros((len(lat), 12))
+CLUSTERING_COLUMNS = ['tmean_1', 'prec_1', 'tmean_2', 'prec_2', 'tmean_3',
+       'prec_3', 'tmean_4', 'prec_4', 'tmean_5', 'prec_5', 'tmean_6', 'prec_6',
+       'tmean_7', 'prec_7', 'tmean_8', 'prec_8', 'tmean_9', 'prec_9',
+       'tmean_10', 'prec_10', 'tmean_11', 'prec_11', 'tmean_12', 'prec_12']
 
-    for i in range(12):
-        tmean_us[:,i] = tmean_data[i][lon_idx, lat_idx]
-        prec_us[:,i] = prec_data[i][lon_idx, lat_idx]
+CLUSTERING_BACKENDS = ('kmeans', 'minibatch')
 
-    tmean_scaler = StandardScaler().fit(tmean_us)
-    prec_scaler = StandardScaler().fit(prec_us)
 
-    tmean_us = tmean_scaler.transform(tmean_us)
-    prec_us = prec_scaler.transform(prec_us)
+def get_kmean_score(n, us_df):
 
-    for j in range(12):
-        new_tmean_col = "tmean_" + str(j+1)
-        new_prec_col = "prec_" + str(j+1)
+    kmeans = KMeans(n_clusters=n, random_state=0, n_init="auto").fit(X=us_df[CLUSTERING_COLUMNS])
+    score = kmeans.score(X=us_df[CLUSTERING_COLUMNS])
+    return score
 
-        us_df[new_tmean_col] = tmean_us[:,j]
-        us_df[new_prec_col] = prec_us[:,j]
 
-    return us_df, tmean_scaler, prec_scaler
+def _fit_clustering(n, X, backend, random_state, batch_size):
+    ''' Fit one KMeans or MiniBatchKMeans model with n clusters '''
+    if backend == 'minibatch':
+        model = MiniBatchKMeans(n_clusters=n, random_state=random_state, n_init="auto", batch_size=batch_size)
+    else:
+        model = KMeans(n_clusters=n, random_state=random_state, n_init="auto")
+    return model.fit(X)
 
-def swiss_data_preparation(tmean_data, prec_data, switzerland, tmean_scaler, prec_scaler):
 
-    ch_pixel_indices, ch_pixel_coords, _ = find_coordinates(tmean_data[0], switzerland)
+def sweep_kmeans(X, n_clusters=range(2, 9), backend='kmeans', n_jobs=-1, sample_size=2000, random_state=0, batch_size=4096):
+    ''' Fit one clustering model per number of clusters in parallel, and keep the fitted models.
+    
+    Input:
+        X: np.array or pd.DataFrame of shape (n_samples, n_features)
+            Data to cluster
 
-    lon = [x[0] for x in ch_pixel_coords]
-    lat = [x[1] for x in ch_pixel_coords]
-    ch_df = pd.DataFrame({"lat": lat, "lon": lon})
+        n_clusters: iterable of int
+            Numbers of clusters to try
 
-    lon_idx = [x[0] for x in ch_pixel_indices]
-    lat_idx = [x[1] for x in ch_pixel_indices]
+        backend: str
+            'kmeans' (KMeans) or 'minibatch' (MiniBatchKMeans, for millions of full resolution pixels)
 
-    # standardize daza
-    tmean_ch = np.zeros((len(lat), 12)) 
-    prec_ch = np.zeros((len(lat), 12))
+        n_jobs: int
+            Number of models fitted in parallel (joblib, -1 for all the CPUs)
 
-    for i in range(12):
-        tmean_ch[:,i] = tmean_data[i][lon_idx, lat_idx]
-        prec_ch[:,i] = prec_data[i][lon_idx, lat_idx]
+        sample_size: int or None
+            Number of points on which the silhouette is computed (None: all the points, quadratic cost)
 
-    tmean_ch = tmean_scaler.transform(tmean_ch)
-    prec_ch = prec_scaler.transform(prec_ch)
+        random_state: int
+            Seed of the models and of the silhouette sample
 
-    for j in range(12):
-        new_tmean_col = "tmean_" + str(j+1)
-        new_prec_col = "prec_" + str(j+1)
+        batch_size: int
+            Size of the mini-batches of the 'minibatch' backend
 
-        ch_df[new_tmean_col] = tmean_ch[:,j]
-        ch_df[new_prec_col] = prec_ch[:,j]
-    
-    return ch_df
+    Output:
+        models: dict
+            Fitted model per number of clusters
 
-def get_kmean_score(n, us_df):
+        report: pd.DataFrame
+            n_clusters, inertia (sum of squared distances on X), score (-inertia, as KMeans.score) and silhouette (on the sample)
+    '''
+    if backend not in CLUSTERING_BACKENDS:
+        raise ValueError(f"Unknown clustering backend '{backend}', expected one of {CLUSTERING_BACKENDS}.")
+    X = np.asarray(X)
+    n_clusters = [int(n) for n in n_clusters]
 
-    clustering_cols = ['tmean_1', 'prec_1', 'tmean_2', 'prec_2', 'tmean_3',
-       'prec_3', 'tmean_4', 'prec_4', 'tmean_5', 'prec_5', 'tmean_6', 'prec_6',
-       'tmean_7', 'prec_7', 'tmean_8', 'prec_8', 'tmean_9', 'prec_9',
-       'tmean_10', 'prec_10', 'tmean_11', 'prec_11', 'tmean_12', 'prec_12']
-    
-    kmeans = KMeans(n_clusters=n, random_state=0, n_init="auto").fit(X=us_df[clustering_cols])
-    score = kmeans.score(X=us_df[clustering_cols])
-    return score
+    fitted = Parallel(n_jobs=n_jobs)(delayed(_fit_clustering)(n, X, backend, random_state, batch_size) for n in n_clusters)
+    models = dict(zip(n_clusters, fitted))
+
+    inertia = np.array([models[n].inertia_ for n in n_clusters])
+    silhouette = np.array([
+        silhouette_score(X, models[n].labels_, sample_size=sample_size if sample_size and sample_size < len(X) else None,
+                         random_state=random_state)
+        for n in n_clusters
+    ])
+    report = pd.DataFrame({"n_clusters": n_clusters, "inertia": inertia, "score": -inertia, "silhouette": silhouette})
 
+    return models, report
 
-def weather_clustering(us_df, ch_df):
+
+def weather_clustering(us_df, ch_df, n_clusters=range(2, 9), chosen_n=5, backend='kmeans', n_jobs=-1, sample_size=2000):
     ''' Performs clustering on weather data:
 
     Input:
@@ -524,6 +1412,21 @@ def weather_clustering(us_df, ch_df):
         ch_df: pd.DataFrame
             Data whose label needs to be predicted
 
+        n_clusters: iterable of int
+            Numbers of clusters tried, fitted in parallel (see sweep_kmeans)
+
+        chosen_n: int
+            Number of clusters of the model used for the labels (reused from the sweep)
+
+        backend: str
+            'kmeans' or 'minibatch' (MiniBatchKMeans, for full resolution data)
+
+        n_jobs: int
+            Number of models fitted in parallel
+
+        sample_size: int or None
+            Number of points on which the silhouette is computed
+
     Output: 
         clustered_df: pd.DataFrame
             us_df with additional "labels" column corresponding to the assigned cluster
@@ -538,65 +1441,236 @@ def weather_clustering(us_df, ch_df):
             list of labels corresponding to each point in ch_df.
     
     '''
+    n_clusters = np.asarray(list(n_clusters))
+    models, report = sweep_kmeans(us_df[CLUSTERING_COLUMNS], n_clusters, backend=backend, n_jobs=n_jobs, sample_size=sample_size)
+    scores = report['score'].to_numpy()
+
+    # choose n_cluster = 5 for next analysis, reusing the model of the sweep
+    if chosen_n not in models:
+        models[chosen_n] = _fit_clustering(chosen_n, np.asarray(us_df[CLUSTERING_COLUMNS]), backend, 0, 4096)
+    kmeans_5 = models[chosen_n]
+    labels = kmeans_5.labels_
+    ch_labels = kmeans_5.predict(X=np.asarray(ch_df[CLUSTERING_COLUMNS]))
 
-    clustering_cols = ['tmean_1', 'prec_1', 'tmean_2', 'prec_2', 'tmean_3',
-       'prec_3', 'tmean_4', 'prec_4', 'tmean_5', 'prec_5', 'tmean_6', 'prec_6',
-       'tmean_7', 'prec_7', 'tmean_8', 'prec_8', 'tmean_9', 'prec_9',
-       'tmean_10', 'prec_10', 'tmean_11', 'prec_11', 'tmean_12', 'prec_12']
+    clustered_df = pd.DataFrame({"lat": us_df['lat'], "lon": us_df['lon'], "labels": labels})
+    # Keep the exact pixel of every point when known (see extract_region_features)
+    if 'row' in us_df and 'col' in us_df:
+        clustered_df.insert(0, 'col', us_df['col'].to_numpy())
+        clustered_df.insert(0, 'row', us_df['row'].to_numpy())
+
+    return clustered_df, n_clusters, scores, ch_labels
+
+class ClusterLookup:
+    ''' Climate cluster of any location, from a global cluster-label raster computed once.
     
-    scores = np.zeros(len(range(2,9)))
-    n_clusters = np.arange(2, 9)
+    Point queries are answered by indexing the raster at the pixel containing each point (O(1) per point).
+    Points falling on nodata pixels (sea, coasts at coarse resolution) or outside the grid fall back to the
+    label of the nearest valid pixel, found with a KD-tree over the pixel centers built on first use.
 
-    for n in n_clusters:
-        scores[n-2] = get_kmean_score(n, us_df)
+    Input:
+        labels: np.array of shape (H, W), int
+            Cluster label of every pixel of the global WGS84 grid, -1 where there is no climatic data
 
-    # choose n_cluster = 5 for next analysis
+        max_distance: float
+            Largest distance (in degrees) of the nearest valid pixel used by the fallback; -1 beyond it
+    '''
 
-    kmeans_5 = KMeans(n_clusters=5, random_state=0, n_init="auto").fit(X=us_df[clustering_cols])
-    labels = kmeans_5.labels_
-    ch_labels = kmeans_5.predict(X=ch_df[clustering_cols])
+    def __init__(self, labels, max_distance=1.0):
+        self.labels = labels
+        self.max_distance = max_distance
+        self.pixel_size = 360 / labels.shape[1]
+        self.transform = from_origin(-180, 90, self.pixel_size, self.pixel_size)
+        self._tree = None
+        self._tree_labels = None
+
+    @classmethod
+    def from_clustering(cls, model, stacks, scalers, block_rows=256, max_distance=1.0):
+        ''' Predict the cluster of every valid pixel of the globe, in blocks of rows.
+        
+        Input:
+            model: fitted KMeans or MiniBatchKMeans
+                Clustering model (e.g. from weather_clustering or sweep_kmeans)
+
+            stacks: dict
+                Monthly climatic data of shape (12, H, W) per variable, in the order of the features (e.g. {'tmean': tmean_data, 'prec': prec_data})
+
+            scalers: dict
+                Fitted StandardScaler per variable (e.g. from extract_region_features)
+
+            block_rows: int
+                Number of grid rows predicted at once (bounds the memory used)
+
+        Output:
+            lookup: ClusterLookup
+        '''
+        variables = list(stacks)
+        height, width = stacks[variables[0]].shape[-2:]
+        labels = np.full((height, width), -1, dtype=np.int16)
+
+        for start in range(0, height, block_rows):
+            stop = min(start + block_rows, height)
+            values = {variable: np.asarray(stacks[variable][:, start:stop]).reshape(12, -1).T for variable in variables}
+            valid = np.logical_and.reduce([np.isfinite(values[variable]).all(axis=1) for variable in variables])
+            if not valid.any():
+                continue
+
+            # Features in the clustering order: tmean_1, prec_1, ..., tmean_12, prec_12, standardized in float64 as
+            # in extract_region_features, in the dtype the model was fitted on (predict rejects any other)
+            features = np.empty((int(valid.sum()), 12 * len(variables)), dtype=model.cluster_centers_.dtype)
+            for k, variable in enumerate(variables):
+                features[:, k::len(variables)] = scalers[variable].transform(values[variable][valid].astype(np.float64))
+            if hasattr(model, 'feature_names_in_'):
+                features = pd.DataFrame(features, columns=model.feature_names_in_)
+            labels[start:stop].reshape(-1)[valid] = model.predict(features)
+
+        return cls(labels, max_distance=max_distance)
+
+    def _nearest(self, lat, lon):
+        ''' Label of the nearest valid pixel center of every point '''
+        if self._tree is None:
+            rows, cols = np.nonzero(self.labels >= 0)
+            centers = pixel_coordinates(rows + 0.5, cols + 0.5, self.transform)
+            self._tree = cKDTree(centers)
+            self._tree_labels = self.labels[rows, cols]
+
+        distance, nearest = self._tree.query(np.column_stack((lon, lat)), distance_upper_bound=self.max_distance)
+        found = np.isfinite(distance)
+        out = np.full(len(lat), -1, dtype=np.int64)
+        out[found] = self._tree_labels[nearest[found]]
+        return out
+
+    def query(self, lat, lon):
+        ''' Cluster label of one point or of arrays of points.
+        
+        Input:
+            lat, lon: float or np.array
+                Coordinates in WGS84
+
+        Output:
+            labels: int or np.array of int
+                Cluster label of every point, -1 when no valid pixel is within max_distance or when a coordinate is
+                missing (NaN)
+        '''
+        scalar = np.ndim(lat) == 0
+        lat, lon = np.atleast_1d(np.asarray(lat, dtype=np.float64)), np.atleast_1d(np.asarray(lon, dtype=np.float64))
+        finite = np.isfinite(lat) & np.isfinite(lon)
+
+        rows = np.floor(np.where(finite, (90 - lat) / self.pixel_size, -1)).astype(np.int64)
+        cols = np.floor(np.where(finite, (lon + 180) / self.pixel_size, -1)).astype(np.int64)
+        inside = (rows >= 0) & (rows < self.labels.shape[0]) & (cols >= 0) & (cols < self.labels.shape[1])
+
+        out = np.full(len(lat), -1, dtype=np.int64)
+        out[inside] = self.labels[rows[inside], cols[inside]]
+
+        # Coastal, nodata and out of grid points: nearest valid pixel (points without coordinates stay at -1)
+        missing = (out < 0) & finite
+        if missing.any():
+            out[missing] = self._nearest(lat[missing], lon[missing])
+
+        return int(out[0]) if scalar else out
+
+    def query_frame(self, df, lat='lat', lon='lon'):
+        ''' Cluster label of every row of a DataFrame of locations (e.g. cities).
+        
+        Output:
+            labels: pd.Series of int, aligned on df
+        '''
+        return pd.Series(self.query(df[lat].to_numpy(), df[lon].to_numpy()), index=df.index, name='labels')
 
-    clustered_df = pd.DataFrame({"lat": us_df['lat'], "lon": us_df['lon'], "labels": labels})
 
-    return clustered_df, n_clusters, scores, ch_labels
+def majority_labels_per_region(region_codes, labels, n_regions):
+    """
+    Majority label of every region, from the region code and the label of every point, in one pass.
 
-def interpolate_labels(clustered_df, us_df):
+    Parameters:
+        region_codes (np.array): Position of the region of every point (0 to n_regions - 1).
+        labels (np.array): Label of every point.
+        n_regions (int): Number of regions.
+
+    Returns:
+        np.array: Majority label of every region, -1 for regions without points. Ties go to the label
+        seen first among the points of the region, as Counter.most_common does.
+    """
+    region_codes = np.asarray(region_codes, dtype=np.int64)
+    values, label_codes = np.unique(np.asarray(labels), return_inverse=True)
+    n_labels = max(len(values), 1)
+
+    # Histogram of the labels of every region: bin region * n_labels + label
+    bins = region_codes * n_labels + label_codes
+    counts = np.bincount(bins, minlength=n_regions * n_labels).reshape(n_regions, n_labels)
+
+    # Position of the first point of every (region, label), to break ties like Counter
+    first_seen = np.full(n_regions * n_labels, len(bins), dtype=np.int64)
+    np.minimum.at(first_seen, bins, np.arange(len(bins)))
+    first_seen = first_seen.reshape(n_regions, n_labels)
+
+    is_max = counts == counts.max(axis=1, keepdims=True)
+    majority = np.argmin(np.where(is_max, first_seen, len(bins) + 1), axis=1)
+
+    out = np.full(n_regions, -1, dtype=np.int64)
+    non_empty = counts.sum(axis=1) > 0
+    out[non_empty] = values[majority[non_empty]]
+    return out
+
+
+def interpolate_labels(clustered_df, us_df, method='sjoin', grid_shape=None):
     """
     Interpolates the labels for each state based on majority voting of points in clustered_df.
 
     Parameters:
-        clustered_df (pd.DataFrame): DataFrame containing longitude ('lon'), latitude ('lat'), and labels ('labels').
+        clustered_df (pd.DataFrame): DataFrame containing longitude ('lon'), latitude ('lat'), and labels ('labels'),
+            and optionally the pixel of every point ('row', 'col').
         us_gdf (gpd.GeoDataFrame): GeoDataFrame containing state geometries.
+        method (str): 'sjoin' (points intersecting each state) or 'raster' (state of the pixel containing each point,
+            from the states rasterized once on the global WGS84 grid, without any spatial join; expects one point per
+            pixel, as produced by data_preparation).
+        grid_shape (tuple): Shape (H, W) of the climatic data grid, required by the 'raster' method.
 
     Returns:
         list: List of labels (int) assigned to each state based on majority voting.
     """
-    # Convert clustered_df to a GeoDataFrame
-    clustered_gdf = gpd.GeoDataFrame(
-        clustered_df,
-        geometry=gpd.points_from_xy(clustered_df['lon'], clustered_df['lat']),
-        crs=us_df.crs
-    )
-
-    clustered_gdf = clustered_gdf.to_crs(us_df.crs)
-    joined_gdf = gpd.sjoin(clustered_gdf, us_df, how="inner", predicate="intersects")
-
-    majority_labels = []
+    if method == 'raster':
+        if grid_shape is None:
+            raise ValueError("The 'raster' method needs the grid_shape of the climatic data.")
+        pixel_size = 360 / grid_shape[1]
+        transform = from_origin(-180, 90, pixel_size, pixel_size)
+        zonal = ZonalStats.from_geometries(us_df.geometry.values, grid_shape, transform)
+
+        # Pixel of every point, then its states. Clustered points are the upper-left corners of their pixels, so
+        # rounding recovers the pixel even when the coordinates went through float32
+        if 'row' in clustered_df and 'col' in clustered_df:
+            rows, cols = clustered_df['row'].to_numpy(np.int64), clustered_df['col'].to_numpy(np.int64)
+        else:
+            rows = np.rint((90 - clustered_df['lat'].to_numpy(np.float64)) / pixel_size).astype(np.int64)
+            cols = np.rint((clustered_df['lon'].to_numpy(np.float64) + 180) / pixel_size).astype(np.int64)
+        inside = (rows >= 0) & (rows < grid_shape[0]) & (cols >= 0) & (cols < grid_shape[1])
+        point_of_pixel = np.full(grid_shape[0] * grid_shape[1], -1, dtype=np.int64)
+        point_of_pixel[rows[inside] * grid_shape[1] + cols[inside]] = np.flatnonzero(inside)
+        points = point_of_pixel[zonal.pixels]
+        found = points >= 0
+
+        order = np.argsort(points[found], kind='stable')
+        region_codes = zonal.pixel_labels[found][order]
+        labels = clustered_df['labels'].to_numpy()[points[found][order]]
+
+    elif method == 'sjoin':
+        # Convert clustered_df to a GeoDataFrame
+        clustered_gdf = gpd.GeoDataFrame(
+            clustered_df[['labels']],
+            geometry=gpd.points_from_xy(clustered_df['lon'], clustered_df['lat']),
+            crs=us_df.crs
+        )
+        joined_gdf = gpd.sjoin(clustered_gdf, us_df[['geometry']], how="inner", predicate="intersects")
 
-    # Iterate over each state in us_gdf
-    for state_index, state_row in us_df.iterrows():
-        points_in_state = joined_gdf[joined_gdf.index_right == state_index]
+        region_codes = us_df.index.get_indexer(joined_gdf['index_right'])
+        labels = joined_gdf['labels'].to_numpy()
 
-        if not points_in_state.empty:
-            label_counts = Counter(points_in_state['labels'])
-            majority_label = label_counts.most_common(1)[0][0]
-        else:
-            # Handle cases with no points in a state (e.g., assign -1 as no label)
-            majority_label = -1
+    else:
+        raise ValueError(f"Unknown method '{method}', expected 'sjoin' or 'raster'.")
 
-        majority_labels.append(majority_label)
+    majority_labels = majority_labels_per_region(region_codes, labels, len(us_df))
 
-    return majority_labels
+    return majority_labels.tolist()
 
 def get_best_rated(data_usa):
 
@@ -619,6 +1693,84 @@ def get_best_rated(data_usa):
 
     return best_rated_per_state
 
+def enrich_ratings_with_climate(ratings, region_names, t_stats, p_stats, labels=None, location_column='location_user',
+                                date_column='date', prefix='United States, ', chunk_size=1_000_000):
+    ''' Attach the monthly climate (and cluster label) of the user's region to every rating, without any merge.
+    
+    The region of every rating is encoded as an integer code (from its location, with the prefix stripped)
+    and its month as 0-11, and the values are gathered from dense (n_regions, 12) arrays, chunk by chunk.
+
+    Input:
+        ratings: pd.DataFrame
+            Ratings with a location column (e.g. "United States, California") and a datetime column
+
+        region_names: iterable of str
+            Name of every region, in the order of the climate arrays (e.g. us['name'])
+
+        t_stats, p_stats: np.array of shape (12, n_regions)
+            Monthly temperature and precipitation per region (as returned by generate_usgdfs)
+
+        labels: iterable of int or None
+            Cluster label of every region (e.g. from interpolate_labels), -1 for none
+
+        location_column, date_column: str
+            Columns of the location of the user and of the date of the rating
+
+        prefix: str
+            Prefix removed from the locations to get region names
+
+        chunk_size: int
+            Number of ratings processed at once
+
+    Output:
+        enriched: pd.DataFrame
+            ratings with float32 'tmean' and 'prec' columns (NaN for ratings outside the regions or without date)
+            and, if labels is given, an int16 'cluster' column (-1 outside the regions)
+    '''
+    region_index = {str(name).strip(): code for code, name in enumerate(region_names)}
+    n_regions = len(region_index)
+
+    # Dense (n_regions, 12) tables, with a last row of NaN for ratings outside the regions
+    tmean_table = np.vstack([np.asarray(t_stats, dtype=np.float32).T, np.full((1, 12), np.nan, dtype=np.float32)])
+    prec_table = np.vstack([np.asarray(p_stats, dtype=np.float32).T, np.full((1, 12), np.nan, dtype=np.float32)])
+    label_table = None if labels is None else np.append(np.asarray(labels, dtype=np.int16), np.int16(-1))
+
+    n = len(ratings)
+    tmean = np.empty(n, dtype=np.float32)
+    prec = np.empty(n, dtype=np.float32)
+    cluster = None if label_table is None else np.empty(n, dtype=np.int16)
+
+    for start in range(0, n, chunk_size):
+        stop = min(start + chunk_size, n)
+
+        # Integer code of the region of every rating: factorize the chunk, then map the few unique locations
+        location_codes, locations = pd.factorize(ratings[location_column].iloc[start:stop])
+        names = pd.Index(locations).astype(str).str.replace(prefix, '', regex=False).str.strip()
+        code_of_location = np.append(np.array([region_index.get(name, n_regions) for name in names], dtype=np.int64), n_regions)
+        region = code_of_location[location_codes]  # missing locations (code -1) map to the NaN row
+
+        # Month of every rating (0-11), ratings without date map to the NaN row
+        dates = ratings[date_column].iloc[start:stop]
+        if not pd.api.types.is_datetime64_any_dtype(dates):
+            dates = pd.to_datetime(dates, errors='coerce')
+        month = dates.dt.month.to_numpy(dtype=np.float64, na_value=np.nan)
+        no_date = np.isnan(month)
+        month = np.where(no_date, 1, month).astype(np.int64) - 1
+
+        tmean[start:stop] = tmean_table[np.where(no_date, n_regions, region), month]
+        prec[start:stop] = prec_table[np.where(no_date, n_regions, region), month]
+        if cluster is not None:
+            cluster[start:stop] = label_table[region]
+
+    enriched = ratings.copy(deep=False)
+    enriched['tmean'] = tmean
+    enriched['prec'] = prec
+    if cluster is not None:
+        enriched['cluster'] = cluster
+
+    return enriched
+
+
 def get_favbeer_map(merged_gdf):
 
     label_4_group = merged_gdf[merged_gdf["labels"] == 4]
@@ -634,27 +1786,21 @@ def get_favbeer_map(merged_gdf):
         print(f" {i+1}. {beer}")
 
 
-    clustered_df = (
-        merged_gdf.groupby('labels').agg({
-            'geometry': lambda x: unary_union(x),  # Perform union operation on geometry
-            'style': lambda x: x.mode()[0]  # Majority voting for the most common style
-        }).reset_index()
-    )
-
-    favbeer_map = {}
-
-    for _, row in clustered_df.iterrows():
-        favbeer_map[row['labels']] = row['style']
+    # Majority voting for the most common style (the dissolved cluster geometries are given by cluster_unions)
+    favbeer_map = merged_gdf.groupby('labels')['style'].agg(lambda x: x.mode()[0]).to_dict()
 
     return favbeer_map
 
-def generate_analysis4_plot(us, n_clusters, kmeans_score, clustered_df, favbeer_map):
+def generate_analysis4_plot(us, n_clusters, kmeans_score, clustered_df, favbeer_map, tolerance=0.01):
 
     fig, ax = plt.subplots(2, 2, figsize=(20,11))
     ax = ax.ravel()
 
+    # Simplified state geometries, shared by every panel
+    us_simple = simplify_geometries(us, tolerance)
+
     # 1st plot - Weather data clustering
-    us.plot(ax=ax[0], color='lightgray')
+    us_simple.plot(ax=ax[0], color='lightgray')
     markersize = 0.005
 
     label_colors = {
@@ -695,10 +1841,10 @@ def generate_analysis4_plot(us, n_clusters, kmeans_score, clustered_df, favbeer_
 
     # 3rd plot - Weather interpolation per state
 
-    us.plot(ax=ax[2], color='lightgray')
+    us_simple.plot(ax=ax[2], color='lightgray')
 
     us['color'] = us['labels'].map(label_colors)
-    us.plot(ax=ax[2], color=us['color'], edgecolor='black', linewidth=0.05)
+    us_simple.plot(ax=ax[2], color=us['color'], edgecolor='black', linewidth=0.05)
 
 
     handles = [ plt.Line2D([0], [0], marker='o', color='w', markerfacecolor=color, markersize=10, label=f'Label {label+1}') for label, color in label_colors.items()]
@@ -710,7 +1856,7 @@ def generate_analysis4_plot(us, n_clusters, kmeans_score, clustered_df, favbeer_
     ax[2].axis('off')
 
     # 4th plot - beer preferences per clustered states
-    us.plot(ax=ax[3], color='lightgray')
+    us_simple.plot(ax=ax[3], color='lightgray')
 
     favbeer_color = {
         'American Double / Imperial IPA': 'darkgoldenrod', #'American Double / Imperial IPA',
@@ -721,7 +1867,10 @@ def generate_analysis4_plot(us, n_clusters, kmeans_score, clustered_df, favbeer_
     us['favbeer'] = us['labels'].map(favbeer_map)
     us['favbeer_color'] = us['favbeer'].map(favbeer_color)
 
-    us.plot(ax=ax[3], color=us['favbeer_color'], edgecolor='black', linewidth=0.05)
+    # One dissolved geometry per cluster (cached per label assignment)
+    unions = cluster_unions(us, us['labels'], tolerance)
+    unions = unions[unions['labels'].map(favbeer_map).map(favbeer_color).notna()]
+    unions.plot(ax=ax[3], color=unions['labels'].map(favbeer_map).map(favbeer_color), edgecolor='black', linewidth=0.05)
 
     handles = [plt.Line2D([0], [0], marker='o', color='w', markerfacecolor=color, markersize=10, label=f'{label}') for label, color in favbeer_color.items()]
     ax[3].legend(handles=handles, title="Favorite beer style", loc='lower right', fontsize='small')
@@ -733,7 +1882,7 @@ def generate_analysis4_plot(us, n_clusters, kmeans_score, clustered_df, favbeer_
     #plt.savefig('analysis4_plot.png', format='png', bbox_inches='tight')
     plt.show()
 
-def plot_switzerland(switzerland, ch_df, ch_labels):
+def plot_switzerland(switzerland, ch_df, ch_labels, tolerance=0.005):
 
        ch_df['labels'] = ch_labels
 
@@ -741,7 +1890,7 @@ def plot_switzerland(switzerland, ch_df, ch_labels):
        fig, ax = plt.subplots()
 
        # 1st plot - Weather data clustering
-       switzerland.plot(ax=ax, color='lightgray')
+       simplify_geometries(switzerland, tolerance).plot(ax=ax, color='lightgray')
 
        label_colors = {
               0: 'mistyrose',
@@ -5,8 +5,10 @@ import nltk
 from wordcloud import WordCloud
 from nltk.corpus import stopwords
 from nltk.tokenize import word_tokenize
-from nltk.stem.porter import *
+from nltk.stem.porter import PorterStemmer
+from nltk.stem import WordNetLemmatizer
 import string
+import json
 import unicodedata
 import re
 from PIL import Image 
@@ -14,7 +16,11 @@ import plotly.express as px
 from plotly.io import write_html
 from src.utils.data_utils import get_beer_style_mapping
 from src.utils.geospatial_utils import get_season
+from src.utils.stats_utils import GroupedTDigest
 import seaborn as sns
+from concurrent.futures import ProcessPoolExecutor
+from scipy import sparse
+from sklearn.feature_extraction.text import CountVectorizer
 
 
 def preprocess_text(text):
@@ -88,7 +94,70 @@ def preprocess_text(text):
 
 
 
-def generate_wordcloud(text, saving_path, name_beer, mask_path='data/img/image_beers.png', dpi=600, figsize=(15, 7.5)):
+def build_normalization_map(texts, method='stem', normalization_map=None):
+    """
+    Builds (or extends) a token -> normalized token map by stemming or lemmatizing each distinct token
+    of the vocabulary once, so the cost grows with the vocabulary size and not with the corpus size.
+
+    Parameters:
+    texts (iterable of str): Preprocessed texts (space separated tokens, as returned by preprocess_text).
+    method (str): 'stem' for the Porter stemmer or 'lemma' for the WordNet lemmatizer.
+    normalization_map (dict, optional): Existing map (e.g. loaded with load_normalization_map). Only the
+    tokens missing from it are normalized.
+
+    Returns:
+    dict: The token -> normalized token map.
+    """
+    if method == 'stem':
+        normalize = PorterStemmer().stem
+    elif method == 'lemma':
+        normalize = WordNetLemmatizer().lemmatize
+    else:
+        raise ValueError(f"Unknown normalization method '{method}', expected 'stem' or 'lemma'.")
+
+    normalization_map = dict(normalization_map or {})
+    vocabulary = set()
+    for text in texts:
+        vocabulary.update(str(text).split())
+
+    for token in vocabulary.difference(normalization_map):
+        normalization_map[token] = normalize(token)
+
+    return normalization_map
+
+
+def save_normalization_map(normalization_map, path):
+    """Saves a token -> normalized token map as a JSON file."""
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(normalization_map, f)
+
+
+def load_normalization_map(path):
+    """Loads a token -> normalized token map saved with save_normalization_map."""
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def normalize_texts(texts, normalization_map):
+    """
+    Applies a token -> normalized token map to preprocessed texts by dictionary lookup, e.g. so that
+    "hoppy", "hops" and "hop" add up to the same word in the clouds. Tokens missing from the map are kept as is.
+
+    Parameters:
+    texts (pd.Series or iterable of str): Preprocessed texts (space separated tokens).
+    normalization_map (dict): Map built with build_normalization_map.
+
+    Returns:
+    pd.Series or list: The normalized texts (a Series with the same index if texts is a Series).
+    """
+    lookup = normalization_map.get
+    normalized = [' '.join([lookup(token, token) for token in str(text).split()]) for text in texts]
+    if isinstance(texts, pd.Series):
+        return pd.Series(normalized, index=texts.index, name=texts.name)
+    return normalized
+
+
+def generate_wordcloud(text, saving_path, name_beer, mask_path='data/img/image_beers.png', dpi=600, figsize=(15, 7.5), frequencies=None):
     """
     Generate and save a word cloud image without plotting it.
     
@@ -99,20 +168,25 @@ def generate_wordcloud(text, saving_path, name_beer, mask_path='data/img/image_b
     - mask_path (str, optional): Path to the image mask. Defaults to 'data/img/image_beers.png'.
     - dpi (int, optional): Resolution of the saved image. Defaults to 600.
     - figsize (tuple, optional): Size of the figure in inches. Defaults to (15, 7.5).
+    - frequencies (dict, optional): Precomputed {word or phrase: weight} dictionary (e.g. from collocation_frequencies).
+      If given, it is used instead of counting the words of text.
 
     Returns:
     None -- displays the word cloud plot.
     """
     beer_mask = np.array(Image.open('data/img/image_beers.png'))
 
-    # Combine text into a single string
-    text_single_string = ' '.join(text)
-
     # Generate the word cloud
     wordcloud = WordCloud(
         width=800, height=400, background_color='white',
         colormap='viridis', mask=beer_mask, contour_width=2
-    ).generate(text_single_string)
+    )
+    if frequencies is not None:
+        wordcloud = wordcloud.generate_from_frequencies(frequencies)
+    else:
+        # Combine text into a single string
+        text_single_string = ' '.join(text)
+        wordcloud = wordcloud.generate(text_single_string)
 
     # Create a figure without displaying it
     fig = plt.figure(figsize=figsize)
@@ -140,26 +214,63 @@ def categorize_rating(avg_score, std_score, num_ratings, liked_threshold, dislik
     # Account for NaN and None values
     if pd.isnull(avg_score):
         return 'Unknown'
-    if ~pd.isnull(std_score):
+    if not pd.isnull(std_score):
         if std_score > polarizing_threshold and num_ratings > significance: #TODO: This num_ratings threshold is arbitrary
             return 'Polarizing' 
-        if avg_score >= liked_threshold:
-            return 'Liked'
-        elif avg_score <= disliked_threshold:
-            return 'Disliked'
-        elif disliked_threshold < avg_score < liked_threshold:
-            return 'Neutral'
-        else:
-            return 'Unknown'
+    if avg_score >= liked_threshold:
+        return 'Liked'
+    elif avg_score <= disliked_threshold:
+        return 'Disliked'
+    elif disliked_threshold < avg_score < liked_threshold:
+        return 'Neutral'
     else:
-        if avg_score >= liked_threshold:
-            return 'Liked'
-        elif avg_score <= disliked_threshold:
-            return 'Disliked'
-        elif disliked_threshold < avg_score < liked_threshold:
-            return 'Neutral'
-        else:
-            return 'Unknown'
+        return 'Unknown'
+
+
+RATING_LABELS = ['Liked', 'Neutral', 'Disliked', 'Polarizing', 'Unknown']
+
+
+def _to_float_array(values):
+    """Converts an array-like to a float64 numpy array, mapping None and non numeric values to NaN."""
+    array = np.asarray(values)
+    if array.dtype.kind in 'fiub':
+        return array.astype(np.float64, copy=False)
+    return pd.to_numeric(pd.Series(array), errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+
+
+def categorize_ratings(avg_scores, std_scores, num_ratings, liked_threshold, disliked_threshold, polarizing_threshold, significance=30):
+    """
+    Vectorized version of categorize_rating, labelling whole columns at once with np.select
+    instead of calling the scalar function once per row through DataFrame.apply.
+
+    Parameters:
+    avg_scores (array-like): The average score of each beer (NaN/None allowed).
+    std_scores (array-like): The standard deviation score of each beer (NaN/None allowed).
+    num_ratings (array-like): The number of ratings of each beer.
+    liked_threshold, disliked_threshold, polarizing_threshold (float or array-like): Same thresholds as categorize_rating,
+    either one value for all beers or one value per beer.
+    significance (int): Minimum number of ratings for a beer to be labelled 'Polarizing'.
+
+    Returns:
+    pd.Categorical: The category of each beer rating, with the same semantics as categorize_rating.
+    """
+    avg = _to_float_array(avg_scores)
+    std = _to_float_array(std_scores)
+    count = _to_float_array(num_ratings)
+
+    # Comparisons with NaN are False, which reproduces the NaN/None branches of the scalar function
+    with np.errstate(invalid='ignore'):
+        conditions = [
+            np.isnan(avg),
+            (std > polarizing_threshold) & (count > significance),
+            avg >= liked_threshold,
+            avg <= disliked_threshold,
+            (disliked_threshold < avg) & (avg < liked_threshold),
+        ]
+    choices = [RATING_LABELS.index(label) for label in ['Unknown', 'Polarizing', 'Liked', 'Disliked', 'Neutral']]
+    codes = np.select(conditions, choices, default=RATING_LABELS.index('Unknown')).astype(np.int8)
+
+    return pd.Categorical.from_codes(codes, categories=RATING_LABELS)
 
     
 
@@ -175,13 +286,15 @@ def apply_per_country_rating(row, significance, liked_threshold, disliked_thresh
     
 
 
-def calculate_ratings_by_country(df, significance, liked_threshold, disliked_threshold):
+def calculate_ratings_by_country(df, significance, liked_threshold, disliked_threshold, stats=None):
     """
     This function calculates the categorized ratings for each beer in the dataset 
     internal to each country or US state.
 
     Parameters:
     df (pd.DataFrame): The input DataFrame containing the beer data with country information stored in the "location_user" column.
+    stats (RatingStatistics, optional): Precomputed (location_user, beer_name) statistics. When given, the averages,
+    standard deviations and counts are read from it instead of being recomputed from the rows of df.
 
     Returns:
     pd.DataFrame: A DataFrame containing the categorized ratings for each beer in the dataset
@@ -200,9 +313,15 @@ def calculate_ratings_by_country(df, significance, liked_threshold, disliked_thr
     countries = df[column_name].unique()
 
     # Initialize new columns in the DataFrame
-    df['avg_score_per_country'] = 0.0
-    df['std_score_per_country'] = 0.0
-    df['num_ratings_per_country'] = 0.0
+    if stats is None:
+        df['avg_score_per_country'] = 0.0
+        df['std_score_per_country'] = 0.0
+        df['num_ratings_per_country'] = 0.0
+    else:
+        per_country = stats.transform(df)
+        df['avg_score_per_country'] = per_country['avg_score']
+        df['std_score_per_country'] = per_country['std_score']
+        df['num_ratings_per_country'] = per_country['num_ratings']
     df['rating_label_per_country'] = None
 
     for country in countries:
@@ -210,15 +329,16 @@ def calculate_ratings_by_country(df, significance, liked_threshold, disliked_thr
         country_data = df[df[column_name] == country]
 
         # Calculate the average and standard deviation scores for each beer in the country
-        country_data.loc[:,'avg_score_per_country'] = country_data.groupby('beer_name')['rating'].transform('mean')
-        country_data.loc[:,'std_score_per_country'] = country_data.groupby('beer_name')['rating'].transform('std')
-        country_data.loc[:,'num_ratings_per_country'] = country_data.groupby('beer_name')['rating'].transform('count')
+        if stats is None:
+            country_data.loc[:,'avg_score_per_country'] = country_data.groupby('beer_name')['rating'].transform('mean')
+            country_data.loc[:,'std_score_per_country'] = country_data.groupby('beer_name')['rating'].transform('std')
+            country_data.loc[:,'num_ratings_per_country'] = country_data.groupby('beer_name')['rating'].transform('count')
 
         # Calculate the 90th percentile of the standard deviation scores for each country
         polarizing_threshold = country_data['std_score_per_country'].quantile(0.9)
 
         # Categorize the rating of each beer in the country
-        country_data.loc[:,'rating_label_per_country'] = country_data.apply(apply_per_country_rating, axis=1, args=(significance, liked_threshold, disliked_threshold, polarizing_threshold))
+        country_data.loc[:,'rating_label_per_country'] = np.asarray(categorize_ratings(country_data['avg_score_per_country'], country_data['std_score_per_country'], country_data['num_ratings_per_country'], liked_threshold, disliked_threshold, polarizing_threshold, significance), dtype=object)
 
         # country_data['rating_label_per_country'] = country_data.apply(apply_per_country_rating, axis=1)
 
@@ -232,6 +352,46 @@ def calculate_ratings_by_country(df, significance, liked_threshold, disliked_thr
     
     return df
 
+
+def label_rating_statistics(stats, significance, liked_threshold, disliked_threshold, quantile=0.9, epsilon=0.005):
+    """
+    Reads out the categorized rating of every (location, beer) pair of a RatingStatistics store,
+    without rescanning the raw ratings.
+
+    The polarizing threshold of each location is the given quantile of the standard deviation scores
+    of its ratings, i.e. each beer's standard deviation weighted by its number of ratings, as in
+    calculate_ratings_by_country.
+
+    Parameters:
+    stats (RatingStatistics): Statistics keyed by (location_user, beer_name).
+    significance (int): Minimum number of ratings for a beer to be labelled 'Polarizing'.
+    liked_threshold, disliked_threshold (float): Thresholds on the average score.
+    quantile (float): Quantile of the standard deviations used as polarizing threshold.
+    epsilon (float, optional): Rank error bound of the t-digest sketches used to estimate the thresholds.
+    If None, the exact quantiles are computed by expanding every beer's standard deviation to its ratings.
+
+    Returns:
+    pd.DataFrame: The statistics summary with the additional columns 'polarizing_threshold' and 'rating_label'.
+    """
+    summary = stats.summary()
+    location = summary.index.get_level_values(0)
+
+    if epsilon is None:
+        # Expand each beer's standard deviation by its number of ratings to get the row-level quantile
+        def weighted_quantile(group):
+            valid = group['std_score'].notna()
+            return pd.Series(np.repeat(group['std_score'][valid].to_numpy(), group['num_ratings'][valid].to_numpy().astype(np.int64))).quantile(quantile)
+
+        thresholds = summary.groupby(location, sort=False).apply(weighted_quantile)
+    else:
+        sketches = GroupedTDigest(epsilon).update(location, summary['std_score'], summary['num_ratings'])
+        thresholds = sketches.quantile(quantile)
+    summary['polarizing_threshold'] = thresholds.reindex(location).to_numpy()
+
+    summary['rating_label'] = categorize_ratings(summary['avg_score'], summary['std_score'], summary['num_ratings'], liked_threshold, disliked_threshold, summary['polarizing_threshold'].to_numpy(), significance)
+
+    return summary
+
 def plot_beer_mapping(output_folder_html="website/_layouts/"):
     """Plots the sunburst diagram of the beer mapping"""
     style_mapping = get_beer_style_mapping()
@@ -253,11 +413,13 @@ def plot_beer_mapping(output_folder_html="website/_layouts/"):
     fig.show()
 
 
-def generate_wordcloud_country(df,country='England'): 
+def generate_wordcloud_country(df,country='England', collocations=None): 
     """This function generates word clouds for all the different beer styles
     Parameters:
     df (pd.DataFrame): The input DataFrame containing the beer data with country information stored in the "location_user" column.
     country : the country we want to plot the wordclouds for 
+    collocations (pd.DataFrame, optional): Collocations scored per style category (extract_collocations on the
+    country's reviews with group_column='style_category'). If given, the clouds show these phrases instead of single words.
     """
     df_country=df[df['country_user']==country]
     # Create word clouds for all beer styles and store their image arrays
@@ -269,10 +431,11 @@ def generate_wordcloud_country(df,country='England'):
     for style in styles:
         path=output_folder_figures+style+'.svg'
         text = df_country[df_country['style_category'] == style]['preprocessed text']
-        wordcloud_images[style] = generate_wordcloud(text,path,style)
+        frequencies = None if collocations is None else collocation_frequencies(collocations, style)
+        wordcloud_images[style] = generate_wordcloud(text,path,style,frequencies=frequencies)
 
 
-def plot_radar_chart(df, country, rating_label, categories):
+def plot_radar_chart(df, country, rating_label, categories, cube=None):
     """
     Generates a radar chart for the top 5 polarizing beers in a given country.
 
@@ -291,18 +454,25 @@ def plot_radar_chart(df, country, rating_label, categories):
     categories : list of str
         The attributes (columns) to include in the radar chart, such as 
         ['aroma', 'palate', 'taste', 'appearance', 'avg_score_per_country'].
+
+    cube : RatingCube, optional
+        Pre-aggregated ratings keyed by beer name. When given, the per-beer means are read
+        from the cube and df is not scanned (it can be None).
     """
     saving_path="website/assets/figures/Top_5_Polarizing_Beers_in_Canada.svg"
-    df_filtered = df[(df['country_user'] == country) & (df['rating_label_per_country'] == rating_label)]
-    df_filtered['beer_names_count'] = df_filtered['beer_name']
-    top_beers = df_filtered.groupby('beer_name').agg({
-        'aroma': 'mean',
-        'palate': 'mean',
-        'taste': 'mean',
-        'appearance': 'mean',
-        'avg_score_per_country': 'mean',
-        'std_score_per_country': 'mean', 'beer_names_count':'count'
-    }).reset_index()
+    if cube is None:
+        df_filtered = df[(df['country_user'] == country) & (df['rating_label_per_country'] == rating_label)]
+        df_filtered['beer_names_count'] = df_filtered['beer_name']
+        top_beers = df_filtered.groupby('beer_name').agg({
+            'aroma': 'mean',
+            'palate': 'mean',
+            'taste': 'mean',
+            'appearance': 'mean',
+            'avg_score_per_country': 'mean',
+            'std_score_per_country': 'mean', 'beer_names_count':'count'
+        }).reset_index()
+    else:
+        top_beers = cube.item_means(country, rating_label)
     
     top_beers = top_beers[top_beers['beer_names_count']>10] #filter beers with more than 10 ratings
     # Sort and select the top 5 beers, by best average per sountry
@@ -341,7 +511,7 @@ def plot_radar_chart(df, country, rating_label, categories):
 
 
 
-def plot_combined_distribution(df, one_sigma, minus_one_sigma,country='Canada'):
+def plot_combined_distribution(df, one_sigma, minus_one_sigma,country='Canada', polarizing_threshold=None, cube=None):
     """
     Combines the overall rating distribution and standard deviation distribution plots into subplots.
 
@@ -355,19 +525,34 @@ def plot_combined_distribution(df, one_sigma, minus_one_sigma,country='Canada'):
         The threshold for "liked" ratings (default is None).
     minus_one_sigma : float, optional
         The threshold for "disliked" ratings (default is None).
+    polarizing_threshold : float, optional
+        Precomputed polarizing threshold, e.g. from a TDigest built in a streaming pass. If None, the 90th
+        percentile of 'std_score_per_country' is computed on df.
+    cube : RatingCube, optional
+        Pre-aggregated ratings. When given, the histograms and the polarizing threshold are read
+        from the cube and df is not scanned (it can be None).
     """
     output_folder_svg = "website/assets/figures/"
     
     # Calculate the polarizing threshold for the standard deviation
-    too_high_std = df['std_score_per_country'].quantile(0.9)
-    df_country = df[df['country_user'] == country]
+    if polarizing_threshold is not None:
+        too_high_std = polarizing_threshold
+    elif cube is not None:
+        too_high_std = cube.polarizing_threshold(0.9)
+    else:
+        too_high_std = df['std_score_per_country'].quantile(0.9)
     
     fig, axes = plt.subplots(1, 2, figsize=(20, 6))
     
     # Plot 1: Overall Rating Distribution
-    df_country['rating'].astype(float).plot(
-        kind='hist', bins=20, ax=axes[0], color='purple', edgecolor='black', alpha=0.7
-    )
+    if cube is None:
+        df_country = df[df['country_user'] == country]
+        df_country['rating'].astype(float).plot(
+            kind='hist', bins=20, ax=axes[0], color='purple', edgecolor='black', alpha=0.7
+        )
+    else:
+        rating_counts, rating_edges, std_counts, std_edges = cube.histograms(country)
+        axes[0].hist(rating_edges[:-1], bins=rating_edges, weights=rating_counts, color='purple', edgecolor='black', alpha=0.7)
     axes[0].set_title('Overall Distribution of Beer Ratings in ' + country, fontsize=14)
     axes[0].set_xlabel('Rating', fontsize=12)
     axes[0].set_ylabel('Frequency', fontsize=12)
@@ -377,9 +562,12 @@ def plot_combined_distribution(df, one_sigma, minus_one_sigma,country='Canada'):
     axes[0].grid(True, linestyle='--', alpha=0.6)
     
     # Plot 2: Standard Deviation Distribution
-    df_country['std_score_per_country'].plot(
-        kind='hist', bins=30, ax=axes[1], color='purple', edgecolor='black', alpha=0.7
-    )
+    if cube is None:
+        df_country['std_score_per_country'].plot(
+            kind='hist', bins=30, ax=axes[1], color='purple', edgecolor='black', alpha=0.7
+        )
+    else:
+        axes[1].hist(std_edges[:-1], bins=std_edges, weights=std_counts, color='purple', edgecolor='black', alpha=0.7)
     axes[1].axvline(too_high_std, color='red', linestyle='--', linewidth=2, label='Polarizing threshold')
     axes[1].set_title('Standard Deviation Distribution of Ratings for ' + country, fontsize=14)
     axes[1].set_xlabel('Standard Deviation', fontsize=12)
@@ -436,4 +624,359 @@ def generate_wordclouds(df,seasonal=True,  mask_path='data/img/image_beers.png',
         plt.show()
 
 
-    
\ No newline at end of file
+    
+
+def _mix64(x):
+    """SplitMix64 finalizer, used to scramble uint64 hashes (wrapping arithmetic)."""
+    x = x ^ (x >> np.uint64(30))
+    x = x * np.uint64(0xbf58476d1ce4e5b9)
+    x = x ^ (x >> np.uint64(27))
+    x = x * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+
+def _ngram_hashes(token_hashes, starts, n):
+    """Combines the hashes of the n consecutive tokens beginning at each start position."""
+    h = token_hashes[starts]
+    for k in range(1, n):
+        h = _mix64(h * np.uint64(31) + token_hashes[starts + k])
+    return h
+
+
+class NgramCounter:
+    """
+    Bounded-memory n-gram counter for collocation extraction over a stream of preprocessed reviews.
+
+    Unigram and n-gram counts of every group are stored in one count-min sketch (depth x width counters),
+    keyed by a stable hash of (group, n-gram), so the memory does not grow with the corpus. The strings of
+    the most frequent n-grams of each chunk are kept as candidates (at most max_candidates per group and n).
+    Counters built on different chunks or processes can be merged by adding their sketches.
+
+    Parameters:
+    n_values (tuple of int): Sizes of the n-grams to count (e.g. bigrams and trigrams).
+    width (int): Number of counters per sketch row (rounded up to a power of 2).
+    depth (int): Number of sketch rows (independent hash functions).
+    max_candidates (int): Number of candidate n-gram strings kept per group and n.
+    """
+
+    def __init__(self, n_values=(2, 3), width=2**22, depth=4, max_candidates=2000):
+        self.n_values = tuple(n_values)
+        self.bits = int(np.ceil(np.log2(width)))
+        self.depth = depth
+        self.max_candidates = max_candidates
+        self.table = np.zeros((depth, 2**self.bits), dtype=np.int64)
+        rng = np.random.default_rng(0)
+        self._multipliers = rng.integers(1, 2**63, size=depth, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+        self.token_totals = pd.Series(dtype=np.int64)
+        self.candidates = pd.DataFrame({'group': pd.Series(dtype=object), 'ngram': pd.Series(dtype=object),
+                                        'n': pd.Series(dtype=np.int64), 'key': pd.Series(dtype=np.uint64)})
+
+    def _indices(self, keys):
+        shift = np.uint64(64 - self.bits)
+        return [((keys * multiplier) >> shift).astype(np.int64) for multiplier in self._multipliers]
+
+    def _add(self, keys):
+        for row, idx in enumerate(self._indices(keys)):
+            self.table[row] += np.bincount(idx, minlength=self.table.shape[1])
+
+    def estimate(self, keys):
+        """Returns the count-min estimate of the count of each hashed key."""
+        keys = np.asarray(keys, dtype=np.uint64)
+        return np.min([self.table[row, idx] for row, idx in enumerate(self._indices(keys))], axis=0)
+
+    @staticmethod
+    def _group_hashes(groups):
+        return _mix64(pd.util.hash_array(np.asarray(groups, dtype=object)))
+
+    def update(self, texts, groups):
+        """
+        Counts the unigrams and n-grams of a chunk of preprocessed reviews.
+
+        Parameters:
+        texts (array-like of str): Preprocessed reviews (space separated tokens, as returned by preprocess_text).
+        groups (array-like): Group of each review (e.g. country or style category).
+
+        Returns:
+        NgramCounter: The updated counter (self).
+        """
+        token_lists = [str(text).split() for text in texts]
+        lengths = np.fromiter(map(len, token_lists), dtype=np.int64, count=len(token_lists))
+        groups = np.asarray(groups, dtype=object)
+        self.token_totals = self.token_totals.add(pd.Series(lengths).groupby(groups).sum(), fill_value=0).astype(np.int64)
+        if lengths.sum() == 0:
+            return self
+
+        tokens = np.fromiter((token for token_list in token_lists for token in token_list), dtype=object, count=lengths.sum())
+        token_hashes = pd.util.hash_array(tokens)
+        doc = np.repeat(np.arange(len(token_lists)), lengths)
+        group_hashes = self._group_hashes(groups)[doc]
+
+        self._add(_mix64(token_hashes ^ group_hashes))
+        new_candidates = []
+        for n in self.n_values:
+            # n-grams must not cross review boundaries
+            starts = np.flatnonzero(doc[:len(doc) - n + 1] == doc[n - 1:])
+            if starts.size == 0:
+                continue
+            keys = _mix64(_ngram_hashes(token_hashes, starts, n) ^ group_hashes[starts])
+            self._add(keys)
+
+            # Keep the strings of the most frequent n-grams of the chunk as candidates
+            unique_keys, first, counts = np.unique(keys, return_index=True, return_counts=True)
+            frame = pd.DataFrame({'group': groups[doc[starts[first]]], 'key': unique_keys, 'count': counts, 'first': starts[first]})
+            frame = frame.sort_values('count', ascending=False, kind='stable').groupby('group', sort=False).head(self.max_candidates)
+            frame['ngram'] = [' '.join(tokens[i:i + n]) for i in frame['first']]
+            frame['n'] = n
+            new_candidates.append(frame[['group', 'ngram', 'n', 'key']])
+
+        self._update_candidates(new_candidates)
+        return self
+
+    def merge(self, other):
+        """
+        Merges another counter (with the same parameters) into this one.
+
+        Returns:
+        NgramCounter: The merged counter (self).
+        """
+        if other.table.shape != self.table.shape or other.n_values != self.n_values:
+            raise ValueError("Cannot merge n-gram counters with different parameters.")
+        self.table += other.table
+        self.token_totals = self.token_totals.add(other.token_totals, fill_value=0).astype(np.int64)
+        self._update_candidates([other.candidates])
+        return self
+
+    def _update_candidates(self, frames):
+        candidates = pd.concat([self.candidates] + frames, ignore_index=True).drop_duplicates('key')
+        if len(candidates) == 0:
+            return
+        candidates['count'] = self.estimate(candidates['key'].to_numpy(dtype=np.uint64))
+        candidates = candidates.sort_values('count', ascending=False, kind='stable').groupby(['group', 'n'], sort=False).head(self.max_candidates)
+        self.candidates = candidates[['group', 'ngram', 'n', 'key']].reset_index(drop=True)
+
+    def score(self, min_count=5):
+        """
+        Scores the candidate n-grams of every group with pointwise mutual information and Dunning's
+        log-likelihood ratio.
+
+        For a bigram xy, PMI = log2(c(xy) N / (c(x) c(y))) and the likelihood ratio is computed on the 2x2
+        contingency table of x and y, with a negative sign when xy is rarer than expected (see _log_likelihood_ratio). Trigrams xyz use PMI = log2(c(xyz) N^2 / (c(x) c(y) c(z))) and the
+        contingency table of the bigram xy and z. N is the number of tokens of the group.
+
+        Parameters:
+        min_count (int): Minimum estimated count of an n-gram to be scored.
+
+        Returns:
+        pd.DataFrame: Columns 'group', 'ngram', 'n', 'count', 'pmi' and 'llr', sorted by group and decreasing llr.
+        """
+        scored = []
+        for n, candidates in self.candidates.groupby('n'):
+            n = int(n)
+            token_hashes = pd.util.hash_array(np.array([token for ngram in candidates['ngram'] for token in ngram.split(' ')], dtype=object)).reshape(-1, n)
+            group_hashes = self._group_hashes(candidates['group'])
+            counts = self.estimate(candidates['key'].to_numpy(dtype=np.uint64)).astype(np.float64)
+            unigrams = np.stack([self.estimate(_mix64(token_hashes[:, k] ^ group_hashes)) for k in range(n)], axis=1).astype(np.float64)
+            total = candidates['group'].map(self.token_totals).to_numpy(dtype=np.float64)
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                pmi = np.log2(counts * total ** (n - 1) / unigrams.prod(axis=1))
+                if n == 2:
+                    left = unigrams[:, 0]
+                else:
+                    prefix = _ngram_hashes(token_hashes[:, :n - 1].ravel(), np.arange(0, token_hashes[:, :n - 1].size, n - 1), n - 1)
+                    left = self.estimate(_mix64(prefix ^ group_hashes)).astype(np.float64)
+                llr = _log_likelihood_ratio(counts, left, unigrams[:, -1], total)
+
+            scored.append(pd.DataFrame({'group': candidates['group'].to_numpy(), 'ngram': candidates['ngram'].to_numpy(), 'n': n,
+                                        'count': counts.astype(np.int64), 'pmi': pmi, 'llr': llr}))
+
+        if not scored:
+            return pd.DataFrame({'group': [], 'ngram': [], 'n': [], 'count': [], 'pmi': [], 'llr': []})
+        scores = pd.concat(scored, ignore_index=True)
+        scores = scores[scores['count'] >= min_count]
+        return scores.sort_values(['group', 'llr'], ascending=[True, False]).reset_index(drop=True)
+
+
+def _log_likelihood_ratio(k11, row, col, total):
+    """
+    Dunning's G^2 statistic of the 2x2 contingency table given by a joint count and its marginals, signed:
+    negative when the joint count is below its expected value (the tokens avoid each other). G^2 itself is
+    two-sided, so without the sign frequent anti-collocations would rank like collocations.
+    """
+    k12 = np.maximum(row - k11, 0)
+    k21 = np.maximum(col - k11, 0)
+    k22 = np.maximum(total - row - col + k11, 0)
+
+    def term(k, expected):
+        return np.where(k > 0, k * np.log(np.where(k > 0, k, 1) / expected), 0.0)
+
+    expected = row * col / total
+    g2 = 2 * (term(k11, expected) + term(k12, row * (total - col) / total)
+              + term(k21, (total - row) * col / total) + term(k22, (total - row) * (total - col) / total))
+    return np.where(k11 < expected, -g2, g2)
+
+
+def _ngram_counter_worker(args):
+    # Fold a contiguous partition of the reviews, chunk by chunk, into a single sketch returned once
+    texts, groups, chunk_size, params = args
+    counter = NgramCounter(**params)
+    for i in range(0, len(texts), chunk_size):
+        counter.update(texts[i:i + chunk_size], groups[i:i + chunk_size])
+    return counter
+
+
+def extract_collocations(df, group_column, text_column='preprocessed text', n_values=(2, 3), chunk_size=100000,
+                         n_jobs=1, min_count=5, width=2**22, depth=4, max_candidates=2000):
+    """
+    Extracts and scores bigram/trigram collocations per group in one streaming pass over the reviews.
+
+    Parameters:
+    df (pd.DataFrame): The reviews, with the preprocessed text and the group column.
+    group_column (str): Column defining the groups (e.g. 'country_user' or 'style_category').
+    text_column (str): Column containing the preprocessed text.
+    n_values (tuple of int): Sizes of the n-grams to extract.
+    chunk_size (int): Number of reviews per chunk.
+    n_jobs (int): Number of processes, each counting one contiguous partition of the reviews chunk by chunk.
+    min_count (int): Minimum count of a scored n-gram.
+    width, depth, max_candidates: Sketch parameters, see NgramCounter.
+
+    Returns:
+    pd.DataFrame: The scored collocations, see NgramCounter.score.
+    """
+    params = dict(n_values=n_values, width=width, depth=depth, max_candidates=max_candidates)
+    texts, groups = df[text_column].to_numpy(), df[group_column].to_numpy()
+
+    if n_jobs == 1:
+        counter = _ngram_counter_worker((texts, groups, chunk_size, params))
+    else:
+        # One contiguous partition per worker: each sketch table is built and sent back only once
+        bounds = np.linspace(0, len(df), n_jobs + 1).astype(int)
+        counter = NgramCounter(**params)
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = [executor.submit(_ngram_counter_worker, (texts[start:stop], groups[start:stop], chunk_size, params))
+                       for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+            # Merge in partition order, so ties between candidates do not depend on scheduling
+            for future in futures:
+                counter.merge(future.result())
+
+    return counter.score(min_count=min_count)
+
+
+def collocation_frequencies(collocations, group, score='llr', top=200):
+    """
+    Converts the scored collocations of one group into a {phrase: weight} dictionary, which can be passed
+    to generate_wordcloud (frequencies argument) or WordCloud.generate_from_frequencies.
+
+    Parameters:
+    collocations (pd.DataFrame): Output of extract_collocations.
+    group: The group to keep.
+    score (str): Column used as weight ('llr', 'pmi' or 'count'). Only positive weights are kept, so with
+    'llr' or 'pmi' n-grams rarer than expected by chance are left out.
+    top (int): Number of phrases to keep.
+
+    Returns:
+    dict: The phrase weights.
+    """
+    group_scores = collocations[(collocations['group'] == group) & (collocations[score] > 0)]
+    group_scores = group_scores.nlargest(top, score)
+    return dict(zip(group_scores['ngram'], group_scores[score]))
+
+
+# Aspect/sentiment lexicon used to score the reviews on the same aspects as the ratings.
+# Weights are positive for favourable descriptors and negative for unfavourable ones.
+ASPECT_LEXICON = {
+    'aroma': {
+        'fragrant': 1.0, 'floral': 0.5, 'citrus': 0.5, 'fruity': 0.5, 'piney': 0.5, 'fresh': 1.0, 'pleasant': 1.0,
+        'inviting': 1.0, 'skunky': -1.0, 'musty': -1.0, 'stale': -1.0, 'cardboard': -1.0, 'faint': -0.5,
+        'solventy': -1.0, 'diacetyl': -1.0,
+    },
+    'palate': {
+        'smooth': 1.0, 'creamy': 1.0, 'crisp': 1.0, 'silky': 1.0, 'velvety': 1.0, 'refreshing': 1.0,
+        'thin': -1.0, 'watery': -1.0, 'flat': -1.0, 'harsh': -1.0, 'astringent': -1.0, 'cloying': -1.0,
+        'syrupy': -0.5, 'overcarbonated': -1.0,
+    },
+    'taste': {
+        'delicious': 1.0, 'tasty': 1.0, 'rich': 1.0, 'complex': 1.0, 'balanced': 1.0, 'flavorful': 1.0,
+        'bland': -1.0, 'boring': -1.0, 'burnt': -0.5, 'artificial': -1.0, 'metallic': -1.0, 'medicinal': -1.0,
+        'oxidized': -1.0, 'unbalanced': -1.0,
+    },
+    'appearance': {
+        'clear': 0.5, 'golden': 0.5, 'beautiful': 1.0, 'lacing': 1.0, 'retention': 1.0, 'frothy': 0.5,
+        'brilliant': 1.0, 'murky': -1.0, 'dull': -1.0, 'lifeless': -1.0, 'muddy': -1.0, 'cloudy': -0.5,
+    },
+}
+
+
+def build_lexicon_matrix(lexicon=ASPECT_LEXICON):
+    """
+    Turns an {aspect: {term: weight}} lexicon into a sparse (n_terms x n_aspects) weight matrix.
+
+    Parameters:
+    lexicon (dict): The aspect/sentiment lexicon. Terms may be single tokens or space separated n-grams.
+
+    Returns:
+    tuple: (terms, aspects, weights) where weights is a scipy.sparse.csr_matrix of float32.
+    """
+    aspects = list(lexicon)
+    terms = sorted({term for aspect in aspects for term in lexicon[aspect]})
+    term_index = {term: i for i, term in enumerate(terms)}
+
+    rows, cols, values = [], [], []
+    for j, aspect in enumerate(aspects):
+        for term, weight in lexicon[aspect].items():
+            rows.append(term_index[term])
+            cols.append(j)
+            values.append(weight)
+    weights = sparse.csr_matrix((np.asarray(values, dtype=np.float32), (rows, cols)), shape=(len(terms), len(aspects)))
+    return terms, aspects, weights
+
+
+def score_aspects(texts, lexicon=ASPECT_LEXICON, normalize=True):
+    """
+    Scores every review on each aspect of the lexicon with one sparse matrix product between the
+    term-document matrix of the reviews and the lexicon weight matrix.
+
+    Parameters:
+    texts (iterable of str): Preprocessed texts (space separated tokens).
+    lexicon (dict): The {aspect: {term: weight}} lexicon.
+    normalize (bool): If True, the score of an aspect is the weighted sum divided by the sum of the absolute
+    weights of the matched terms (between -1 and 1, 0 when the aspect is not mentioned). Otherwise the raw sum.
+
+    Returns:
+    pd.DataFrame: One float32 column per aspect, one row per text.
+    """
+    terms, aspects, weights = build_lexicon_matrix(lexicon)
+    max_n = max(len(term.split(' ')) for term in terms)
+    vectorizer = CountVectorizer(vocabulary=terms, tokenizer=str.split, token_pattern=None, lowercase=False,
+                                 ngram_range=(1, max_n), dtype=np.float32)
+    texts = texts if isinstance(texts, pd.Series) else pd.Series(list(texts))
+    counts = vectorizer.transform(texts.fillna('').astype(str))
+
+    scores = (counts @ weights).toarray()
+    if normalize:
+        matched = (counts @ abs(weights)).toarray()
+        scores = np.divide(scores, matched, out=np.zeros_like(scores), where=matched > 0)
+
+    return pd.DataFrame(scores.astype(np.float32), columns=aspects, index=texts.index)
+
+
+def add_aspect_scores(df, text_column='preprocessed text', lexicon=ASPECT_LEXICON, suffix='_text_score', normalize=True):
+    """
+    Adds the lexicon-based aspect scores of the reviews as float32 columns (e.g. 'aroma_text_score')
+    next to the existing aroma, palate, taste and appearance ratings.
+
+    Parameters:
+    df (pd.DataFrame): The reviews, with the preprocessed text column.
+    text_column (str): Column containing the preprocessed text.
+    lexicon (dict): The {aspect: {term: weight}} lexicon.
+    suffix (str): Suffix appended to the aspect names to build the new column names.
+    normalize (bool): See score_aspects.
+
+    Returns:
+    pd.DataFrame: A copy of df with the new columns.
+    """
+    scores = score_aspects(df[text_column], lexicon=lexicon, normalize=normalize)
+    df_out = df.copy()
+    for aspect in scores.columns:
+        df_out[aspect + suffix] = scores[aspect].to_numpy()
+    return df_out
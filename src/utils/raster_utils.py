@@ -0,0 +1,352 @@
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+import rasterio
+from rasterio.features import geometry_mask
+from rasterio.windows import Window, from_bounds, transform as window_transform
+
+DOWNSAMPLING_METHODS = ('mean', 'nanmean', 'max', 'min')
+
+
+def downsample(array, factor, method='mean', nodata=None):
+    ''' Downsample a raster (or a stack of rasters) by an integer factor, without copying it into blocks.
+
+    The last two axes are viewed as (rows // factor, factor, cols) with a reshape: the rows of every block
+    are reduced together, then the columns, so every block of factor x factor pixels becomes one pixel.
+    Trailing rows and columns that do not fill a whole block are dropped, like torch.nn.AvgPool2d does.
+
+    Input:
+        array: np.array of shape (..., H, W)
+            Raster values
+
+        factor: int
+            Downsampling factor (block size and stride)
+
+        method: str
+            'mean', 'nanmean' (ignores NaN values), 'max' or 'min'
+
+        nodata: float or None
+            Nodata value of the raster (e.g. src.nodata). Pixels equal to it are ignored by every method,
+            and blocks without any valid pixel become NaN.
+
+    Output:
+        data: np.array of shape (..., H // factor, W // factor), float32
+            Downsampled raster
+    '''
+    if method not in DOWNSAMPLING_METHODS:
+        raise ValueError(f"Unknown downsampling method '{method}', expected one of {DOWNSAMPLING_METHODS}.")
+    factor = int(factor)
+    if factor < 1:
+        raise ValueError("The downsampling factor must be a positive integer.")
+
+    array = np.asarray(array)
+    lead = array.shape[:-2]
+    height, width = array.shape[-2] // factor, array.shape[-1] // factor
+    array = array[..., :height * factor, :width * factor]
+
+    def block_reduce(ufunc, values, dtype=None):
+        # Reduce the rows of each block first (adding whole contiguous rows), then the columns
+        rows = ufunc.reduce(values.reshape(*lead, height, factor, width * factor), axis=-2, dtype=dtype)
+        return ufunc.reduce(rows.reshape(*lead, height, width, factor), axis=-1)
+
+    # Number of pixels of a block fits in uint16 up to factor 255 (reducing uint8 flags is much faster than bools)
+    count_dtype = np.uint16 if factor**2 < 2**16 else np.int64
+
+    # Mean of an integer raster with a nodata value: sum the raw blocks and take the nodata values back out,
+    # which only needs a count of the nodata pixels per block instead of a masked copy of the array
+    if method in ('mean', 'nanmean') and array.dtype.kind in 'iu' and nodata is not None and not np.isnan(nodata):
+        invalid = array == nodata
+        if not invalid.any():
+            return block_reduce(np.add, array, dtype=np.float32) / np.float32(factor**2)
+        info = np.iinfo(array.dtype)
+        # float32 sums of integers are exact below 2**24, otherwise accumulate in float64
+        sum_dtype = np.float32 if factor**2 * max(abs(int(info.min)), int(info.max)) < 2**24 else np.float64
+        invalid_count = block_reduce(np.add, invalid.view(np.uint8), dtype=count_dtype)
+        count = factor**2 - invalid_count
+        total = block_reduce(np.add, array, dtype=sum_dtype) - sum_dtype(nodata) * invalid_count
+        return np.where(count > 0, total / np.maximum(count, 1), np.nan).astype(np.float32)
+
+    # Pixels to ignore: nodata values, and NaN values for the nan-aware mean
+    invalid = None
+    if nodata is not None:
+        invalid = np.isnan(array) if np.isnan(nodata) else array == nodata
+    if method == 'nanmean' and array.dtype.kind == 'f':
+        invalid = np.isnan(array) if invalid is None else invalid | np.isnan(array)
+
+    if invalid is not None and not invalid.any():
+        invalid = None
+
+    if invalid is None:
+        if method == 'max':
+            return block_reduce(np.maximum, array).astype(np.float32)
+        if method == 'min':
+            return block_reduce(np.minimum, array).astype(np.float32)
+        return block_reduce(np.add, array, dtype=np.float32) / np.float32(factor**2)
+
+    valid = ~invalid
+    count = block_reduce(np.add, valid.view(np.uint8), dtype=count_dtype)
+    if method == 'max':
+        out = block_reduce(np.maximum, np.where(valid, array, -np.inf))
+    elif method == 'min':
+        out = block_reduce(np.minimum, np.where(valid, array, np.inf))
+    else:
+        out = block_reduce(np.add, np.where(valid, array, 0), dtype=np.float32) / np.maximum(count, 1)
+
+    return np.where(count > 0, out, np.nan).astype(np.float32)
+
+
+ZONAL_STATISTICS = ('count', 'sum', 'mean', 'std', 'min', 'max')
+
+# Zonal engines already built, keyed by (geometries, grid shape, transform, all_touched)
+_ZONAL_CACHE = OrderedDict()
+_ZONAL_CACHE_SIZE = 8
+
+
+def geometry_digest(geometries):
+    ''' Hash of a sequence of geometries (their WKB), used as a cache key for everything derived from them '''
+    digest = hashlib.sha1()
+    for geometry in geometries:
+        digest.update(b'' if geometry is None else geometry.wkb)
+        digest.update(b'|')
+    return digest.hexdigest()
+
+
+def geometry_window(geometry, transform, shape):
+    ''' Pixel window covering the bounds of a geometry, clipped to the grid.
+
+    Input:
+        geometry: shapely geometry
+            Geometry in the coordinate system of the grid
+
+        transform: affine.Affine
+            Transform of the grid
+
+        shape: tuple (H, W)
+            Shape of the grid
+
+    Output:
+        window: rasterio.windows.Window or None
+            Integer window of the pixels whose extent intersects the bounds (None outside the grid)
+    '''
+    window = from_bounds(*geometry.bounds, transform=transform)
+    row_start = max(int(np.floor(window.row_off)), 0)
+    col_start = max(int(np.floor(window.col_off)), 0)
+    row_stop = min(int(np.ceil(window.row_off + window.height)), shape[0])
+    col_stop = min(int(np.ceil(window.col_off + window.width)), shape[1])
+    if row_stop <= row_start or col_stop <= col_start:
+        return None
+    return Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+
+
+def geometry_pixels(geometry, transform, shape, all_touched=False):
+    ''' Rows and columns of the pixels of a grid that belong to a geometry, rasterized only inside its window.
+
+    Like rasterio's geometry_mask, a pixel belongs to the geometry when its center is inside it (or when it
+    touches it with all_touched=True), but the mask is only as large as the bounds of the geometry.
+
+    Output:
+        rows, cols: np.array of int
+            Pixel indices in the full grid
+    '''
+    window = None if geometry is None or geometry.is_empty else geometry_window(geometry, transform, shape)
+    if window is None:
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+    mask = geometry_mask([geometry], out_shape=(window.height, window.width), transform=window_transform(window, transform),
+                         all_touched=all_touched, invert=True)
+    rows, cols = np.nonzero(mask)
+    return rows + window.row_off, cols + window.col_off
+
+
+def _zonal_reduce(values, pixel_labels, n_regions, statistics):
+    ''' Statistics per band and per region of pixel values (B, n_pixels) sorted by region label. '''
+    unknown = set(statistics) - set(ZONAL_STATISTICS)
+    if unknown:
+        raise ValueError(f"Unknown statistics {sorted(unknown)}, expected some of {ZONAL_STATISTICS}.")
+
+    n_bands = values.shape[0]
+    valid = np.isfinite(values)
+    filled = np.where(valid, values, 0.0)
+
+    # One bincount over all bands: band b, region r -> bin b * n_regions + r
+    bins = (np.arange(n_bands)[:, None] * n_regions + pixel_labels[None, :]).ravel()
+    size = n_bands * n_regions
+
+    def binned(weights):
+        return np.bincount(bins, weights=weights.ravel(), minlength=size).reshape(n_bands, n_regions)
+
+    count = binned(valid.astype(np.float64))
+    empty = count == 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        total = binned(filled)
+        mean = np.where(empty, np.nan, total / count)
+
+    out = {}
+    if 'count' in statistics:
+        out['count'] = count.astype(np.int64)
+    if 'sum' in statistics:
+        out['sum'] = np.where(empty, np.nan, total)
+    if 'mean' in statistics:
+        out['mean'] = mean
+    if 'std' in statistics:
+        # Second pass on the deviations, more accurate than sum of squares
+        deviations = np.where(valid, values - np.nan_to_num(mean)[:, pixel_labels], 0.0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            out['std'] = np.where(empty, np.nan, np.sqrt(binned(deviations**2) / count))
+
+    if 'min' in statistics or 'max' in statistics:
+        counts = np.bincount(pixel_labels, minlength=n_regions)
+        non_empty = counts > 0
+        starts = (np.cumsum(counts) - counts)[non_empty]
+        for name, ufunc, fill in (('min', np.minimum, np.inf), ('max', np.maximum, -np.inf)):
+            if name not in statistics:
+                continue
+            result = np.full((n_bands, n_regions), np.nan)
+            if starts.size:
+                result[:, non_empty] = ufunc.reduceat(np.where(valid, values, fill), starts, axis=1)
+            out[name] = np.where(empty, np.nan, result)
+
+    return out
+
+
+class ZonalStats:
+    ''' Per-region statistics of rasters, from region pixels rasterized once.
+
+    Every region geometry is rasterized only inside the pixel window of its bounds, and the flat indices of
+    its pixels are kept, sorted by region. The statistics of a whole stack of bands are then computed in one
+    vectorized pass with np.bincount (count, sum, mean, std) and np.minimum/np.maximum.reduceat (min, max),
+    instead of one full-grid mask and one masked copy per region and per band.
+
+    Like rasterio's geometry_mask, a pixel belongs to a region when its center is inside the geometry, and
+    pixels of overlapping geometries count in each of them.
+
+    Input:
+        pixels: np.array of int
+            Flat indices in the grid of the pixels of every region, sorted by region
+
+        pixel_labels: np.array of int
+            Region index of every pixel
+
+        n_regions: int
+            Number of regions
+
+        shape: tuple (H, W)
+            Shape of the grid
+    '''
+
+    def __init__(self, pixels, pixel_labels, n_regions, shape):
+        self.pixels = pixels
+        self.pixel_labels = pixel_labels
+        self.n_regions = int(n_regions)
+        self.shape = tuple(shape)
+        self.counts = np.bincount(pixel_labels, minlength=self.n_regions)
+
+    @classmethod
+    def from_geometries(cls, geometries, shape, transform, all_touched=False):
+        ''' Rasterize region geometries on a grid, or return the engine cached for the same inputs.
+
+        Input:
+            geometries: iterable of shapely geometries (e.g. gdf.geometry)
+                Regions, in the order of the output statistics
+
+            shape: tuple (H, W)
+                Shape of the raster grid
+
+            transform: affine.Affine
+                Transform of the raster grid
+
+            all_touched: bool
+                Passed to rasterio.features.geometry_mask
+
+        Output:
+            zonal: ZonalStats
+        '''
+        geometries = list(geometries)
+        key = (geometry_digest(geometries), tuple(shape), tuple(transform)[:6], all_touched)
+
+        if key in _ZONAL_CACHE:
+            _ZONAL_CACHE.move_to_end(key)
+            return _ZONAL_CACHE[key]
+
+        pixels, pixel_labels = [np.empty(0, dtype=np.intp)], [np.empty(0, dtype=np.intp)]
+        for i, geometry in enumerate(geometries):
+            rows, cols = geometry_pixels(geometry, transform, shape, all_touched)
+            pixels.append(rows * shape[1] + cols)
+            pixel_labels.append(np.full(rows.size, i, dtype=np.intp))
+        zonal = cls(np.concatenate(pixels), np.concatenate(pixel_labels), len(geometries), shape)
+
+        _ZONAL_CACHE[key] = zonal
+        if len(_ZONAL_CACHE) > _ZONAL_CACHE_SIZE:
+            _ZONAL_CACHE.popitem(last=False)
+        return zonal
+
+    def values(self, stack):
+        ''' Gather the pixels of every region from a raster (H, W) or a stack (B, H, W), as float64 (B, n_pixels) '''
+        stack = np.asarray(stack)
+        if stack.shape[-2:] != self.shape:
+            raise ValueError(f"Raster of shape {stack.shape[-2:]} does not match the zonal grid {self.shape}.")
+        return stack.reshape(-1, self.shape[0] * self.shape[1])[:, self.pixels].astype(np.float64)
+
+    def stats(self, stack, statistics=ZONAL_STATISTICS):
+        ''' Compute statistics of every region for every band, ignoring NaN values.
+
+        Input:
+            stack: np.array of shape (H, W) or (B, H, W)
+                Raster or stack of bands on the grid of the regions
+
+            statistics: iterable of str
+                Among 'count', 'sum', 'mean', 'std' (population), 'min', 'max'
+
+        Output:
+            stats: dict
+                One array of shape (B, n_regions) per statistic (B = 1 for a single raster).
+                Regions without any valid pixel get a count of 0 and NaN for the other statistics.
+        '''
+        return _zonal_reduce(self.values(stack), self.pixel_labels, self.n_regions, statistics)
+
+
+def zonal_stats_from_file(file_name, geometries, bands=None, statistics=ZONAL_STATISTICS, all_touched=False):
+    ''' Per-region statistics of a raster file at full resolution, reading only the window of each region.
+
+    Each geometry is rasterized inside the window of its bounds, and only that window is read from the file,
+    so the statistics of small regions (e.g. Swiss cantons on a 30 arc-second grid) never load the whole raster.
+
+    Input:
+        file_name: str
+            Path to the raster file
+
+        geometries: iterable of shapely geometries
+            Regions, in the coordinate system of the raster
+
+        bands: list of int or None
+            Bands to read (1-based, default: all the bands)
+
+        statistics: iterable of str
+            Among 'count', 'sum', 'mean', 'std' (population), 'min', 'max'
+
+        all_touched: bool
+            Passed to rasterio.features.geometry_mask
+
+    Output:
+        stats: dict
+            One array of shape (n_bands, n_regions) per statistic. Nodata pixels are ignored.
+    '''
+    geometries = list(geometries)
+    with rasterio.open(file_name) as src:
+        bands = list(range(1, src.count + 1)) if bands is None else list(bands)
+        shape = (src.height, src.width)
+        values, pixel_labels = [np.empty((len(bands), 0))], [np.empty(0, dtype=np.intp)]
+
+        for i, geometry in enumerate(geometries):
+            window = None if geometry is None or geometry.is_empty else geometry_window(geometry, src.transform, shape)
+            if window is None:
+                continue
+            mask = geometry_mask([geometry], out_shape=(window.height, window.width),
+                                 transform=window_transform(window, src.transform), all_touched=all_touched, invert=True)
+            data = src.read(bands, window=window)[:, mask].astype(np.float64)
+            if src.nodata is not None:
+                data[(np.isnan(data) if np.isnan(src.nodata) else data == src.nodata)] = np.nan
+            values.append(data)
+            pixel_labels.append(np.full(data.shape[1], i, dtype=np.intp))
+
+    return _zonal_reduce(np.concatenate(values, axis=1), np.concatenate(pixel_labels), len(geometries), statistics)
@@ -0,0 +1,424 @@
+import numpy as np
+import pandas as pd
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+
+
+class RatingStatistics:
+    """
+    Online store of per-key rating statistics (count, mean and M2, the sum of squared deviations).
+
+    Ratings can be folded in chunk by chunk, and partial stores computed on separate chunks or processes
+    can be merged together. Each merge uses the parallel form of Welford's update (Chan et al.), so the
+    means and standard deviations read from the store are the same as the ones computed on the full data.
+
+    Parameters:
+    keys (list of str): Columns identifying a group, by default the user location and the beer name.
+    value (str): Column containing the ratings.
+    """
+
+    def __init__(self, keys=('location_user', 'beer_name'), value='rating'):
+        self.keys = list(keys)
+        self.value = value
+        index = pd.MultiIndex.from_arrays([[] for _ in self.keys], names=self.keys)
+        self.state = pd.DataFrame({'count': [], 'mean': [], 'm2': []}, index=index, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.state)
+
+    def update(self, df):
+        """
+        Folds a chunk of ratings into the store.
+
+        Parameters:
+        df (pd.DataFrame): Chunk containing the key columns and the rating column.
+
+        Returns:
+        RatingStatistics: The updated store (self).
+        """
+        grouped = df.groupby(self.keys, sort=False, observed=True)[self.value]
+        partial = pd.DataFrame({'count': grouped.count(), 'mean': grouped.mean(), 'm2': grouped.var(ddof=0)}).astype(np.float64)
+        partial = partial[partial['count'] > 0]
+        partial['m2'] = partial['m2'] * partial['count']
+        if not isinstance(partial.index, pd.MultiIndex):
+            partial.index = pd.MultiIndex.from_arrays([partial.index], names=self.keys)
+
+        return self._combine(partial)
+
+    def merge(self, other):
+        """
+        Merges the partial state of another store (built on other chunks or in another process) into this one.
+
+        Parameters:
+        other (RatingStatistics): Store with the same keys and value column.
+
+        Returns:
+        RatingStatistics: The merged store (self).
+        """
+        if other.keys != self.keys or other.value != self.value:
+            raise ValueError("Cannot merge rating statistics computed on different keys or values.")
+        return self._combine(other.state)
+
+    def _combine(self, partial):
+        if len(self.state) == 0:
+            self.state = partial.copy()
+            return self
+        index = self.state.index.union(partial.index)
+        a = self.state.reindex(index, fill_value=0.0)
+        b = partial.reindex(index, fill_value=0.0)
+
+        count = a['count'] + b['count']
+        delta = b['mean'] - a['mean']
+        self.state = pd.DataFrame({
+            'count': count,
+            'mean': a['mean'] + delta * b['count'] / count,
+            'm2': a['m2'] + b['m2'] + delta ** 2 * a['count'] * b['count'] / count,
+        }, index=index)
+        return self
+
+    def summary(self):
+        """
+        Reads out the current statistics of every key.
+
+        Returns:
+        pd.DataFrame: Indexed by the keys, with the columns 'avg_score', 'std_score' (sample standard
+        deviation, NaN for a single rating as in pandas) and 'num_ratings'.
+        """
+        count = self.state['count']
+        with np.errstate(invalid='ignore', divide='ignore'):
+            std = np.sqrt(self.state['m2'] / (count - 1)).where(count > 1)
+        return pd.DataFrame({'avg_score': self.state['mean'], 'std_score': std, 'num_ratings': count})
+
+    def transform(self, df):
+        """
+        Broadcasts the statistics of each key to the rows of df, like groupby(...).transform does.
+
+        Parameters:
+        df (pd.DataFrame): DataFrame containing the key columns.
+
+        Returns:
+        pd.DataFrame: Same index as df, with the columns 'avg_score', 'std_score' and 'num_ratings'.
+        """
+        summary = self.summary()
+        positions = summary.index.get_indexer(pd.MultiIndex.from_frame(df[self.keys]))
+        values = summary.to_numpy()
+        out = np.full((len(df), values.shape[1]), np.nan)
+        found = positions >= 0
+        out[found] = values[positions[found]]
+        return pd.DataFrame(out, index=df.index, columns=summary.columns)
+
+
+def _rating_statistics_worker(args):
+    chunk, keys, value = args
+    return RatingStatistics(keys, value).update(chunk)
+
+
+def compute_rating_statistics(chunks, keys=('location_user', 'beer_name'), value='rating', n_jobs=1):
+    """
+    Builds a RatingStatistics store from an iterable of DataFrame chunks (e.g. pd.read_csv(..., chunksize=...)).
+
+    Parameters:
+    chunks (iterable of pd.DataFrame): Chunks of ratings.
+    keys (list of str): Columns identifying a group.
+    value (str): Column containing the ratings.
+    n_jobs (int): Number of processes used to compute the partial states, which are then merged.
+
+    Returns:
+    RatingStatistics: The store containing the statistics of all the chunks.
+    """
+    stats = RatingStatistics(keys, value)
+    if n_jobs == 1:
+        for chunk in chunks:
+            stats.update(chunk)
+        return stats
+
+    # Keep at most 2 * n_jobs chunks in flight, so a lazy source (read_csv chunks) is never fully loaded,
+    # and fold the partial states as soon as they complete
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        pending = set()
+        for chunk in chunks:
+            if len(pending) >= 2 * n_jobs:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stats.merge(future.result())
+            pending.add(executor.submit(_rating_statistics_worker, (chunk, list(keys), value)))
+        for future in as_completed(pending):
+            stats.merge(future.result())
+    return stats
+
+
+class TDigest:
+    """
+    Mergeable approximate-quantile sketch (merging t-digest with the k1 scale function).
+
+    Values are buffered and periodically compressed into weighted centroids. Compression is vectorized:
+    the sorted values are bucketed by the integer part of the scale function and each bucket is reduced
+    to one centroid. Sketches built on separate chunks or processes can be merged.
+
+    Parameters:
+    epsilon (float): Bound on the rank error of the returned quantiles (0.005 means the quantile of rank q
+    lies between the true quantiles of ranks q - 0.005 and q + 0.005). The memory used is O(1 / epsilon).
+    """
+
+    def __init__(self, epsilon=0.005):
+        self.epsilon = epsilon
+        # Centroids span at most pi / compression in rank, so interpolating between them stays within epsilon
+        self.compression = int(np.ceil(np.pi / epsilon))
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+        self.min = np.inf
+        self.max = -np.inf
+        self._buffer_means = []
+        self._buffer_weights = []
+        self._buffer_size = 0
+
+    def update(self, values, weights=None):
+        """
+        Adds values (optionally weighted, e.g. by a number of ratings) to the sketch. NaN values are ignored.
+
+        Parameters:
+        values (array-like): Values to add.
+        weights (array-like, optional): Positive weight of each value, 1 by default.
+
+        Returns:
+        TDigest: The updated sketch (self).
+        """
+        values = np.asarray(values, dtype=np.float64).ravel()
+        weights = np.ones_like(values) if weights is None else np.asarray(weights, dtype=np.float64).ravel()
+        valid = ~np.isnan(values) & (weights > 0)
+        values, weights = values[valid], weights[valid]
+        if values.size == 0:
+            return self
+
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        self._buffer_means.append(values)
+        self._buffer_weights.append(weights)
+        self._buffer_size += values.size
+        if self._buffer_size > 10 * self.compression:
+            self._compress()
+        return self
+
+    def merge(self, other):
+        """
+        Merges another sketch into this one.
+
+        Parameters:
+        other (TDigest): Sketch built on other values.
+
+        Returns:
+        TDigest: The merged sketch (self).
+        """
+        other._compress()
+        if other.weights.size == 0:
+            return self
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._buffer_means.append(other.means)
+        self._buffer_weights.append(other.weights)
+        self._buffer_size += other.means.size
+        self._compress()
+        return self
+
+    def _compress(self):
+        if self._buffer_size == 0:
+            return
+        means = np.concatenate([self.means] + self._buffer_means)
+        weights = np.concatenate([self.weights] + self._buffer_weights)
+        self._buffer_means, self._buffer_weights, self._buffer_size = [], [], 0
+
+        order = np.argsort(means, kind='stable')
+        means, weights = means[order], weights[order]
+        cumulative = np.cumsum(weights)
+        q = (cumulative - weights) / cumulative[-1]
+
+        # Bucket the sorted centroids by the integer part of the k1 scale function
+        k = np.floor(self.compression / (2 * np.pi) * np.arcsin(2 * q - 1))
+        starts = np.concatenate([[0], np.flatnonzero(np.diff(k)) + 1])
+        self.weights = np.add.reduceat(weights, starts)
+        self.means = np.add.reduceat(weights * means, starts) / self.weights
+
+    def quantile(self, q):
+        """
+        Estimates the quantile(s) q of the values added so far.
+
+        Parameters:
+        q (float or array-like): Quantile(s) between 0 and 1.
+
+        Returns:
+        float or np.ndarray: The estimated quantile(s), NaN if the sketch is empty.
+        """
+        self._compress()
+        if self.weights.size == 0:
+            return np.full(np.shape(q), np.nan) if np.ndim(q) else np.nan
+
+        cumulative = np.cumsum(self.weights)
+        total = cumulative[-1]
+        centers = cumulative - self.weights / 2
+        ranks = np.concatenate([[0], centers, [total]])
+        values = np.concatenate([[self.min], self.means, [self.max]])
+        return np.interp(np.asarray(q, dtype=np.float64) * total, ranks, values)
+
+
+class GroupedTDigest:
+    """
+    One TDigest per group, which can be updated chunk by chunk and merged across chunks or workers.
+
+    Parameters:
+    epsilon (float): Rank error bound of each group's sketch.
+    """
+
+    def __init__(self, epsilon=0.005):
+        self.epsilon = epsilon
+        self.digests = {}
+
+    def update(self, keys, values, weights=None):
+        """
+        Adds values to the sketch of their group.
+
+        Parameters:
+        keys (array-like): Group of each value.
+        values (array-like): Values to add.
+        weights (array-like, optional): Weight of each value, 1 by default.
+
+        Returns:
+        GroupedTDigest: The updated sketches (self).
+        """
+        values = np.asarray(values, dtype=np.float64)
+        weights = None if weights is None else np.asarray(weights, dtype=np.float64)
+        for key, positions in pd.Series(np.arange(len(values))).groupby(np.asarray(keys), sort=False).indices.items():
+            digest = self.digests.setdefault(key, TDigest(self.epsilon))
+            digest.update(values[positions], None if weights is None else weights[positions])
+        return self
+
+    def merge(self, other):
+        """
+        Merges the sketches of another GroupedTDigest into this one.
+
+        Returns:
+        GroupedTDigest: The merged sketches (self).
+        """
+        for key, digest in other.digests.items():
+            self.digests.setdefault(key, TDigest(self.epsilon)).merge(digest)
+        return self
+
+    def quantile(self, q):
+        """
+        Estimates the quantile q of every group.
+
+        Returns:
+        pd.Series: The estimated quantile, indexed by group.
+        """
+        return pd.Series({key: digest.quantile(q) for key, digest in self.digests.items()}, dtype=np.float64)
+
+
+class RatingCube:
+    """
+    Pre-aggregated ratings keyed by (country_user, item, rating_label_per_country), where the item is the
+    beer name or the style category. For every key the cube stores the number of ratings, fixed-bin
+    histograms of the ratings and of the per-country standard deviations, and the sums of the aspect scores.
+
+    Distribution and radar plots can then be drawn for any country from a few cube rows instead of
+    filtering the full ratings DataFrame. Use RatingCube.from_frame to build it.
+    """
+
+    def __init__(self, keys, counts, rating_edges, rating_hist, std_edges, std_hist, sum_columns, sums, sum_counts, std_digest):
+        self.keys = keys
+        self.counts = counts
+        self.rating_edges = rating_edges
+        self.rating_hist = rating_hist
+        self.std_edges = std_edges
+        self.std_hist = std_hist
+        self.sum_columns = list(sum_columns)
+        self.sums = sums
+        self.sum_counts = sum_counts
+        self.std_digest = std_digest
+        self._country_rows = keys.groupby(keys.columns[0], sort=False).indices
+
+    @classmethod
+    def from_frame(cls, df, item='beer_name', rating_bins=np.linspace(0, 5, 41), std_bins=np.linspace(0, 4, 81),
+                   sum_columns=('aroma', 'palate', 'taste', 'appearance', 'avg_score_per_country', 'std_score_per_country'),
+                   epsilon=0.005):
+        """
+        Builds the cube from a ratings DataFrame labelled by calculate_ratings_by_country.
+
+        Parameters:
+        df (pd.DataFrame): Ratings with the columns 'country_user', item, 'rating_label_per_country', 'rating',
+        'std_score_per_country' and the sum_columns.
+        item (str): Second key of the cube, 'beer_name' or 'style_category'.
+        rating_bins, std_bins (np.ndarray): Fixed bin edges of the rating and standard deviation histograms.
+        Values outside the edges are clipped into the first or last bin.
+        sum_columns (list of str): Columns whose sums (and non-null counts) are stored to compute means.
+        epsilon (float): Rank error bound of the t-digest of all the per-country standard deviations.
+
+        Returns:
+        RatingCube: The pre-aggregated cube.
+        """
+        key_columns = ['country_user', item, 'rating_label_per_country']
+        grouped = df.groupby(key_columns, sort=False, observed=True, dropna=False)
+        codes = grouped.ngroup().to_numpy()
+        keys = grouped.size().index.to_frame(index=False)
+        n_keys = len(keys)
+
+        def histogram(values, edges):
+            values = np.asarray(values, dtype=np.float64)
+            valid = ~np.isnan(values)
+            bins = np.clip(np.searchsorted(edges, values[valid], side='right') - 1, 0, len(edges) - 2)
+            n_bins = len(edges) - 1
+            return np.bincount(codes[valid] * n_bins + bins, minlength=n_keys * n_bins).reshape(n_keys, n_bins)
+
+        rating_hist = histogram(df['rating'], rating_bins)
+        std_hist = histogram(df['std_score_per_country'], std_bins)
+
+        values = df[list(sum_columns)].to_numpy(dtype=np.float64)
+        valid = ~np.isnan(values)
+        sums = np.stack([np.bincount(codes, weights=np.where(valid[:, j], values[:, j], 0.0), minlength=n_keys)
+                         for j in range(values.shape[1])], axis=1)
+        sum_counts = np.stack([np.bincount(codes, weights=valid[:, j], minlength=n_keys) for j in range(values.shape[1])], axis=1)
+
+        std_digest = TDigest(epsilon).update(df['std_score_per_country'])
+
+        return cls(keys, np.bincount(codes, minlength=n_keys), np.asarray(rating_bins), rating_hist,
+                   np.asarray(std_bins), std_hist, sum_columns, sums, sum_counts, std_digest)
+
+    def _rows(self, country, rating_label=None):
+        rows = self._country_rows.get(country, np.empty(0, dtype=np.int64))
+        if rating_label is not None:
+            rows = rows[self.keys[self.keys.columns[2]].to_numpy()[rows] == rating_label]
+        return rows
+
+    def histograms(self, country, rating_label=None):
+        """
+        Returns the rating and standard deviation histograms of a country (optionally of one rating label).
+
+        Returns:
+        tuple: (rating_counts, rating_edges, std_counts, std_edges)
+        """
+        rows = self._rows(country, rating_label)
+        return self.rating_hist[rows].sum(axis=0), self.rating_edges, self.std_hist[rows].sum(axis=0), self.std_edges
+
+    def item_means(self, country, rating_label=None):
+        """
+        Returns the mean of every sum column per item of a country (optionally of one rating label).
+
+        Returns:
+        pd.DataFrame: One row per item, with the item column, the means of the sum columns and the number
+        of ratings in 'beer_names_count'. Ratings without item (e.g. a style missing from the style mapping)
+        are left out, as groupby does.
+        """
+        rows = self._rows(country, rating_label)
+        item = self.keys.columns[1]
+        codes, uniques = pd.factorize(self.keys[item].to_numpy()[rows])
+        # Missing items are coded -1: they stay in the histograms of the country, but have no row here
+        rows, codes = rows[codes >= 0], codes[codes >= 0]
+        sums = np.stack([np.bincount(codes, weights=self.sums[rows, j], minlength=len(uniques)) for j in range(len(self.sum_columns))], axis=1)
+        sum_counts = np.stack([np.bincount(codes, weights=self.sum_counts[rows, j], minlength=len(uniques)) for j in range(len(self.sum_columns))], axis=1)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = pd.DataFrame(sums / sum_counts, columns=self.sum_columns)
+        means.insert(0, item, uniques)
+        means['beer_names_count'] = np.bincount(codes, weights=self.counts[rows], minlength=len(uniques)).astype(np.int64)
+        return means
+
+    def polarizing_threshold(self, quantile=0.9):
+        """Estimated quantile of the per-country standard deviations over all the ratings of the cube."""
+        return self.std_digest.quantile(quantile)
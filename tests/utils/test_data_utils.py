@@ -0,0 +1,32 @@
+import numpy as np
+import pandas as pd
+
+from src.utils.data_utils import find_near_duplicate_reviews, remove_near_duplicate_reviews
+
+
+def _reviews():
+    rng = np.random.default_rng(0)
+    words = [f'word{i}' for i in range(500)]
+    texts = [' '.join(rng.choice(words, 40)) for _ in range(200)]
+    # Review 10 cross-posted with one word changed as review 150
+    edited = texts[10].split()
+    edited[-1] = 'changed'
+    texts[150] = ' '.join(edited)
+    return pd.DataFrame({'text': texts})
+
+
+def test_near_duplicates_are_found():
+    pairs = find_near_duplicate_reviews(_reviews())
+    assert list(zip(pairs['idx_a'], pairs['idx_b'])) == [(10, 150)]
+    assert pairs['jaccard'].iloc[0] >= 0.8
+
+
+def test_missing_texts_are_not_near_duplicates():
+    df = _reviews()
+    df.loc[[3, 4, 5], 'text'] = np.nan
+    df.loc[[6, 7], 'text'] = None
+    df.loc[8, 'text'] = ''
+
+    pairs = find_near_duplicate_reviews(df)
+    assert list(zip(pairs['idx_a'], pairs['idx_b'])) == [(10, 150)]
+    assert len(remove_near_duplicate_reviews(df, pairs)) == len(df) - 1
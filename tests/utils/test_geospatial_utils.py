@@ -0,0 +1,242 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio.features import geometry_mask
+from rasterio.transform import from_origin
+import pytest
+from shapely.geometry import MultiPolygon, box
+from sklearn.cluster import KMeans
+
+from src.utils.geospatial_utils import (CLUSTERING_COLUMNS, ClusterLookup, _tile_windows, chelsa_paths, compute_climatology,
+                                        enrich_ratings_with_climate, extract_region_features, get_season, get_seasons,
+                                        interpolate_labels, load_climatology, regional_climate_statistics, top_k_per_group)
+from src.utils.raster_utils import ZonalStats
+
+SHAPE = (90, 180)
+TRANSFORM = from_origin(-180, 90, 2, 2)
+
+
+def _write_raster(path, data, nodata, transform=TRANSFORM):
+    with rasterio.open(path, 'w', driver='GTiff', height=data.shape[0], width=data.shape[1], count=1, dtype=data.dtype,
+                       crs='EPSG:4326', transform=transform, nodata=nodata) as dst:
+        dst.write(data, 1)
+    return path
+
+
+def _write_months(folder, n_months=2, seed=0):
+    rng = np.random.default_rng(seed)
+    paths = []
+    for month in range(1, n_months + 1):
+        data = rng.normal(20, 5, SHAPE).astype(np.float32)
+        data[::9, ::4] = -9999
+        paths.append(_write_raster(str(folder / f'prec_{month:02d}.tif'), data, -9999))
+    return paths
+
+
+def _regions():
+    return gpd.GeoDataFrame(geometry=[
+        box(-20, 30, 15, 55),
+        MultiPolygon([box(170, 60, 180, 70), box(-180, 62, -165, 70)]),  # crosses the antimeridian
+        box(-10, 40, 0, 45),
+        box(200, 0, 210, 10),  # outside the grid
+    ], crs='EPSG:4326')
+
+
+def test_antimeridian_regions_read_narrow_windows():
+    windows = _tile_windows([_regions().geometry[1]], TRANSFORM, SHAPE)
+    assert len(windows) == 2
+    assert sum(window.width for window in windows) < SHAPE[1] // 4
+
+
+def test_regional_climate_statistics_match_full_grid(tmp_path):
+    regions = _regions()
+    paths = _write_months(tmp_path)
+    climate_df = regional_climate_statistics(regions, {'prec': paths}, tile_degrees=30, n_jobs=1)
+
+    assert len(climate_df) == len(regions) * len(paths)
+    assert climate_df['count'].dtype == np.int64
+    zonal = ZonalStats.from_geometries(regions.geometry.values, SHAPE, TRANSFORM)
+    for month, path in enumerate(paths, start=1):
+        with rasterio.open(path) as src:
+            data = src.read(1).astype(np.float64)
+        data[data == -9999] = np.nan
+        reference = zonal.stats(data)
+        month_df = climate_df[climate_df['month'] == month].set_index('region').sort_index()
+        np.testing.assert_array_equal(month_df['count'], reference['count'][0])
+        for name in ('mean', 'std', 'min', 'max'):
+            np.testing.assert_allclose(month_df[name], reference[name][0], rtol=1e-5, equal_nan=True)
+
+    # The region outside the grid has no pixel: a count of 0 and no statistics
+    outside = climate_df[climate_df['region'] == 3]
+    assert (outside['count'] == 0).all() and outside['mean'].isna().all()
+
+
+def test_region_features_keep_exact_pixel_positions():
+    rng = np.random.default_rng(1)
+    shape = (2088, 4320)  # the downsampled CHELSA grid, where float32 coordinates are off by a pixel
+    stacks = {variable: rng.normal(size=(12,) + shape).astype(np.float32) for variable in ('tmean', 'prec')}
+    regions = gpd.GeoDataFrame({'name': ['a', 'b']}, geometry=[box(-100, 30, -98, 32), box(7, 46, 8, 47)], crs='EPSG:4326')
+    features_df, scalers = extract_region_features(regions, stacks, region_column='name')
+
+    assert list(features_df.columns[:5]) == ['region_id', 'row', 'col', 'lat', 'lon']
+    assert features_df['lat'].dtype == np.float64 and features_df['tmean_1'].dtype == np.float32
+    pixel_size = 360 / shape[1]
+    np.testing.assert_array_equal(np.rint((90 - features_df['lat']) / pixel_size), features_df['row'])
+    np.testing.assert_array_equal(np.rint((features_df['lon'] + 180) / pixel_size), features_df['col'])
+
+    # The features of every row are the values of the stacks at (row, col)
+    rows, cols = features_df['row'].to_numpy(), features_df['col'].to_numpy()
+    tmean = scalers['tmean'].inverse_transform(features_df[[f'tmean_{month}' for month in range(1, 13)]].to_numpy())
+    np.testing.assert_allclose(tmean, stacks['tmean'][:, rows, cols].T, rtol=1e-4, atol=1e-4)
+
+
+def test_raster_labels_survive_float32_coordinates():
+    shape = (2088, 4320)
+    pixel_size = 360 / shape[1]
+    states = gpd.GeoDataFrame(geometry=[box(-105, 35, -100, 40), box(-100, 35, -95, 40), box(-95, 30, -90, 33)],
+                              crs='EPSG:4326')
+    rows, cols = np.mgrid[600:720, 900:1080]
+    rows, cols = rows.ravel(), cols.ravel()
+    labels = np.random.default_rng(2).integers(0, 3, rows.size)
+    clustered_df = pd.DataFrame({'row': rows, 'col': cols, 'lat': 90 - rows * pixel_size, 'lon': cols * pixel_size - 180,
+                                 'labels': labels})
+
+    # Majority label of the pixels of every state
+    transform = from_origin(-180, 90, pixel_size, pixel_size)
+    label_grid = np.full(shape, -1)
+    label_grid[rows, cols] = labels
+    expected = []
+    for geometry in states.geometry:
+        mask = geometry_mask([geometry], out_shape=shape, transform=transform, invert=True)
+        values = label_grid[mask & (label_grid >= 0)]
+        expected.append(int(np.bincount(values).argmax()) if values.size else -1)
+
+    assert interpolate_labels(clustered_df, states, method='raster', grid_shape=shape) == expected
+    coarse_df = clustered_df.drop(columns=['row', 'col']).astype({'lat': np.float32, 'lon': np.float32})
+    assert interpolate_labels(coarse_df, states, method='raster', grid_shape=shape) == expected
+
+
+def test_get_seasons_matches_get_season():
+    dates = pd.Series(pd.date_range('2011-12-15', periods=400, freq='D')).sample(frac=1, random_state=0)
+    seasons = get_seasons(dates)
+    pd.testing.assert_index_equal(seasons.index, dates.index)
+    assert seasons.tolist() == [get_season(date) for date in dates]
+    assert get_seasons(pd.Series([pd.NaT, pd.Timestamp('2013-07-01')])).tolist() == [0, 3]
+
+
+@pytest.mark.parametrize('k', [1, 3, 50])
+def test_top_k_per_group_matches_nlargest(k):
+    rng = np.random.default_rng(3)
+    n = 2000
+    df = pd.DataFrame({
+        'season_num': rng.choice([4, 1, 3, 2], n),
+        'style': rng.choice([f'style {i}' for i in range(40)], n),
+        'rating': np.round(rng.uniform(1, 5, n), 1),  # many ties
+    })
+    df.loc[::37, 'rating'] = np.nan
+    df = df[~((df['season_num'] == 3) & (df.index > 60))]  # one small group
+
+    # nlargest keeps missing ratings in groups smaller than k, top_k_per_group never does
+    valid = df[df['rating'].notna()]
+    reference = pd.concat([group.nlargest(k, 'rating') for _, group in valid.groupby('season_num')]).reset_index(drop=True)
+    pd.testing.assert_frame_equal(top_k_per_group(df, 'season_num', 'rating', k), reference)
+
+
+def test_cluster_lookup_reproduces_training_labels():
+    rng = np.random.default_rng(5)
+    shape = (90, 180)
+    pixel_size = 2
+    stacks = {variable: rng.normal(size=(12,) + shape).astype(np.float32) for variable in ('tmean', 'prec')}
+    stacks['tmean'][:, :10] = np.nan  # no data near the pole
+    regions = gpd.GeoDataFrame(geometry=[box(-60, 20, 40, 88)], crs='EPSG:4326')
+
+    features_df, scalers = extract_region_features(regions, stacks)
+    model = KMeans(n_clusters=4, random_state=0, n_init='auto').fit(features_df[CLUSTERING_COLUMNS])
+    lookup = ClusterLookup.from_clustering(model, stacks, scalers, block_rows=7)
+
+    # Query the center of every training pixel
+    lat, lon = features_df['lat'] - pixel_size / 2, features_df['lon'] + pixel_size / 2
+    np.testing.assert_array_equal(lookup.query(lat.to_numpy(), lon.to_numpy()), model.labels_)
+    assert (lookup.labels[:10] == -1).all()
+
+
+def test_cluster_lookup_missing_coordinates():
+    labels = np.full((90, 180), -1, dtype=np.int16)
+    labels[40:50, 80:100] = 2
+    lookup = ClusterLookup(labels, max_distance=5)
+    cities = pd.DataFrame({'lat': [0.5, np.nan, 4.0, -60.0], 'lon': [1.0, 1.0, np.nan, 1.0]}, index=[10, 11, 12, 13])
+
+    assert lookup.query_frame(cities).tolist() == [2, -1, -1, -1]
+    assert lookup.query(np.nan, 0.0) == -1
+
+
+@pytest.mark.parametrize('kernel_size', [1, 3])
+def test_climatology_matches_nan_statistics_over_years(tmp_path, kernel_size):
+    rng = np.random.default_rng(6)
+    years = [2001, 2002, 2003]
+    shape = (31, 47)  # not a multiple of the kernel
+    raw = rng.integers(2500, 3100, size=(len(years), 12) + shape).astype(np.int16)  # tmean in 1/10 K
+    raw[0, :, :5, :8] = -32768  # missing in one year
+    raw[:, :, -6:, -9:] = -32768  # missing in every year
+    raw[1, 4, ::4, ::3] = -32768  # scattered gaps in one month
+    transform = from_origin(-180, 90, 360 / shape[1], 180 / shape[0])
+    (tmp_path / 'data' / 'temp').mkdir(parents=True)
+    for y, year in enumerate(years):
+        for month, path in enumerate(chelsa_paths(str(tmp_path / 'data'), 'tmean', year)):
+            _write_raster(path, raw[y, month], -32768, transform)
+
+    climatology = compute_climatology(str(tmp_path / 'data'), str(tmp_path / 'out'), 'tmean', years=years,
+                                      kernel_size=kernel_size, block_rows=4)
+
+    # Full arrays: downsample every year (mean of the valid pixels of every block), convert, then reduce over years
+    height, width = shape[0] // kernel_size, shape[1] // kernel_size
+    values = np.where(raw == -32768, np.nan, raw.astype(np.float64))[..., :height * kernel_size, :width * kernel_size]
+    values = values.reshape(len(years), 12, height, kernel_size, width, kernel_size)
+    with np.errstate(invalid='ignore'), pytest.warns(RuntimeWarning):
+        values = np.nanmean(values, axis=(3, 5)) * 0.1 - 273.15
+        expected_mean, expected_std = np.nanmean(values, axis=0), np.nanstd(values, axis=0)
+
+    assert climatology['mean'].shape == (12, height, width)
+    np.testing.assert_array_equal(climatology['count'], np.isfinite(values).sum(axis=0))
+    np.testing.assert_allclose(climatology['mean'], expected_mean, rtol=1e-5, atol=1e-4, equal_nan=True)
+    np.testing.assert_allclose(climatology['std'], expected_std, rtol=1e-4, atol=1e-4, equal_nan=True)
+    assert np.isnan(climatology['mean'][:, -1, -1]).all() and (climatology['count'][:, -1, -1] == 0).all()
+
+    reloaded = load_climatology(str(tmp_path / 'out'), 'tmean')
+    np.testing.assert_array_equal(reloaded['mean'], climatology['mean'])
+
+
+def test_enrich_ratings_matches_merge():
+    rng = np.random.default_rng(7)
+    names = ['California', 'Texas', 'Oregon', 'Maine']
+    t_stats = rng.normal(15, 8, (12, len(names)))
+    p_stats = rng.gamma(2, 40, (12, len(names)))
+    labels = [2, 0, 2, 1]
+
+    n = 5000
+    locations = ['United States, ' + name for name in names] + ['United States, Atlantis', 'Belgium']
+    ratings = pd.DataFrame({
+        'location_user': rng.choice(locations, n).astype(object),
+        'date': pd.to_datetime('2010-01-01') + pd.to_timedelta(rng.integers(0, 3 * 365, n), unit='D'),
+        'rating': rng.uniform(1, 5, n),
+    })
+    ratings.loc[::97, 'location_user'] = np.nan
+    ratings.loc[::61, 'date'] = pd.NaT
+    enriched = enrich_ratings_with_climate(ratings, names, t_stats, p_stats, labels=labels, chunk_size=1300)
+
+    # Reference: merge on (region, month) and on region
+    climate = pd.DataFrame({'region': np.repeat(names, 12), 'month': np.tile(np.arange(1, 13), len(names)),
+                            'tmean': t_stats.T.ravel().astype(np.float32), 'prec': p_stats.T.ravel().astype(np.float32)})
+    keys = pd.DataFrame({'region': ratings['location_user'].str.replace('United States, ', '', regex=False),
+                         'month': ratings['date'].dt.month})
+    reference = keys.merge(climate, on=['region', 'month'], how='left')
+    reference = reference.merge(pd.DataFrame({'region': names, 'cluster': labels}), on='region', how='left')
+
+    pd.testing.assert_frame_equal(enriched[ratings.columns], ratings)
+    np.testing.assert_array_equal(enriched['tmean'], reference['tmean'].to_numpy(np.float32))
+    np.testing.assert_array_equal(enriched['prec'], reference['prec'].to_numpy(np.float32))
+    np.testing.assert_array_equal(enriched['cluster'], reference['cluster'].fillna(-1).to_numpy(np.int16))
+    assert enriched['tmean'].dtype == np.float32 and enriched['cluster'].dtype == np.int16
+    assert enriched.loc[ratings['date'].isna(), 'tmean'].isna().all()
+    assert (enriched.loc[ratings['location_user'].isin(['Belgium', 'United States, Atlantis']), 'cluster'] == -1).all()
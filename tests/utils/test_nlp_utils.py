@@ -0,0 +1,126 @@
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.utils.nlp_utils import (NgramCounter, categorize_rating, categorize_ratings, collocation_frequencies,
+                                 extract_collocations)
+
+
+def _rowwise(avg, std, count, liked, disliked, polarizing, significance=30):
+    return [categorize_rating(a, s, n, liked, disliked, polarizing, significance) for a, s, n in zip(avg, std, count)]
+
+
+def _vectorized(avg, std, count, liked, disliked, polarizing, significance=30):
+    return list(categorize_ratings(avg, std, count, liked, disliked, polarizing, significance).astype(str))
+
+
+# Values on both sides of, and exactly on, every threshold (liked 4.0, disliked 3.0, polarizing 0.8, significance 30)
+AVG = [np.nan, None, 2.5, 3.0, 3.0000001, 3.5, 3.9999999, 4.0, 4.5, 4.0, 3.0, 3.5, 3.5, 3.5]
+STD = [0.9, 0.9, np.nan, None, 0.2, 0.8, 0.8000001, 0.9, None, 0.9, 0.9, 1.2, 1.2, np.nan]
+COUNT = [50, 50, 50, 50, 50, 50, 50, 30, 31, 31, 31, 30, 31, np.nan]
+
+
+@pytest.mark.parametrize("as_series", [False, True])
+def test_categorize_ratings_matches_rowwise(as_series):
+    avg, std, count = AVG, STD, COUNT
+    if as_series:
+        avg, std, count = pd.Series(avg, dtype=object), pd.Series(std, dtype=object), pd.Series(count)
+
+    assert _vectorized(avg, std, count, 4.0, 3.0, 0.8) == _rowwise(AVG, STD, COUNT, 4.0, 3.0, 0.8)
+
+
+@pytest.mark.parametrize("liked, disliked, polarizing", [
+    (np.nan, 3.0, 0.8),
+    (4.0, np.nan, 0.8),
+    (4.0, 3.0, np.nan),
+    (np.nan, np.nan, np.nan),
+])
+def test_categorize_ratings_nan_thresholds(liked, disliked, polarizing):
+    assert _vectorized(AVG, STD, COUNT, liked, disliked, polarizing) == _rowwise(AVG, STD, COUNT, liked, disliked, polarizing)
+
+
+def test_categorize_ratings_per_row_thresholds():
+    rng = np.random.default_rng(0)
+    n = 500
+    avg = np.round(rng.uniform(1, 5, n), 1)
+    avg[::17] = np.nan
+    std = np.round(rng.uniform(0, 1.5, n), 1)
+    std[::13] = np.nan
+    count = rng.integers(0, 60, n)
+    polarizing = np.round(rng.uniform(0.5, 1.0, n), 1)
+
+    expected = [categorize_rating(a, s, c, 4.0, 3.0, p, 20) for a, s, c, p in zip(avg, std, count, polarizing)]
+    assert _vectorized(avg, std, count, 4.0, 3.0, polarizing, significance=20) == expected
+
+
+def _reviews(n=600, seed=4):
+    """ Preprocessed reviews of two groups: 'dark chocolate' is a collocation, 'fruit' a frequent token that
+    rarely follows itself """
+    rng = np.random.default_rng(seed)
+    vocab = np.array([f'word{i}' for i in range(25)] + ['fruit'] * 12)
+    texts = []
+    for _ in range(n):
+        tokens = list(rng.choice(vocab, rng.integers(0, 12)))
+        if rng.random() < 0.4:
+            position = rng.integers(0, len(tokens) + 1)
+            tokens[position:position] = ['dark', 'chocolate']
+        # Drop most repeats of 'fruit', so that 'fruit fruit' is rarer than its unigrams imply
+        repeats = [i > 0 and token == 'fruit' == tokens[i - 1] and rng.random() < 0.8 for i, token in enumerate(tokens)]
+        texts.append(' '.join(token for token, repeat in zip(tokens, repeats) if not repeat))
+    return pd.DataFrame({'text': texts, 'group': rng.choice(['Canada', 'Belgium'], n)})
+
+
+def _exact_counts(df, n):
+    counts = Counter()
+    for text, group in zip(df['text'], df['group']):
+        tokens = text.split()
+        counts.update((group, ' '.join(tokens[i:i + n])) for i in range(len(tokens) - n + 1))
+    return counts
+
+
+def test_ngram_counter_counts_match_exact_counts():
+    df = _reviews()
+    counter = NgramCounter(n_values=(2, 3), width=2**16, max_candidates=100000)
+    for start in range(0, len(df), 150):
+        counter.update(df['text'].iloc[start:start + 150], df['group'].iloc[start:start + 150])
+    scores = counter.score(min_count=1)
+
+    unigrams = _exact_counts(df, 1)
+    for n in (2, 3):
+        exact = _exact_counts(df, n)
+        scored = scores[scores['n'] == n]
+        assert dict(zip(zip(scored['group'], scored['ngram']), scored['count'])) == exact
+
+    # PMI of the bigrams from the exact counts
+    totals = {group: sum(count for (g, _), count in unigrams.items() if g == group) for group in ('Canada', 'Belgium')}
+    bigrams = scores[scores['n'] == 2]
+    expected = [np.log2(count * totals[group] / (unigrams[group, ngram.split()[0]] * unigrams[group, ngram.split()[1]]))
+                for group, ngram, count in zip(bigrams['group'], bigrams['ngram'], bigrams['count'])]
+    np.testing.assert_allclose(bigrams['pmi'], expected, rtol=1e-12)
+
+
+def test_log_likelihood_ratio_is_negative_for_anti_collocations():
+    scores = extract_collocations(_reviews(), 'group', text_column='text', width=2**16, max_candidates=100000, min_count=1)
+    # For bigrams both scores compare c(xy) to c(x) c(y) / N, so they agree in sign
+    bigrams = scores[scores['n'] == 2]
+    assert (np.sign(bigrams['llr']) == np.sign(bigrams['pmi'])).all()
+    canada = scores[scores['group'] == 'Canada']
+    assert canada.iloc[0]['ngram'] == 'dark chocolate'
+    assert canada.set_index('ngram').loc['fruit fruit', 'llr'] < 0
+
+    frequencies = collocation_frequencies(scores, 'Canada', score='llr')
+    assert 'fruit fruit' not in frequencies and 'dark chocolate' in frequencies
+    assert all(weight > 0 for weight in frequencies.values())
+
+
+def test_extract_collocations_parallel_matches_serial():
+    df = _reviews()
+    kwargs = dict(text_column='text', chunk_size=100, width=2**16, max_candidates=100000, min_count=2)
+    serial = extract_collocations(df, 'group', n_jobs=1, **kwargs)
+    parallel = extract_collocations(df, 'group', n_jobs=2, **kwargs)
+
+    def ordered(scores):
+        return scores.sort_values(['group', 'n', 'ngram']).reset_index(drop=True)
+    pd.testing.assert_frame_equal(ordered(parallel), ordered(serial))
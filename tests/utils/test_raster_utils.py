@@ -0,0 +1,149 @@
+import numpy as np
+import pytest
+import rasterio
+from rasterio.features import geometry_mask
+from rasterio.transform import from_origin
+from shapely.geometry import Polygon, box
+
+from src.utils.raster_utils import ZonalStats, downsample, zonal_stats_from_file
+
+SHAPE = (90, 180)
+TRANSFORM = from_origin(-180, 90, 2, 2)
+
+GEOMETRIES = [
+    box(-20, 30, 15, 55),
+    Polygon([(-120, 25), (-70, 25), (-95, 50)]),
+    box(0, 40, 40, 60),  # overlaps the first region
+    box(-179, -89, -176, -86),  # a few pixels in the corner of the grid
+    box(200, 0, 210, 10),  # outside the grid
+]
+
+
+def _stack(n_bands=3, seed=0):
+    rng = np.random.default_rng(seed)
+    stack = rng.normal(10, 5, (n_bands,) + SHAPE).astype(np.float32)
+    stack[:, ::7, ::5] = np.nan
+    stack[-1, 20:40, 80:110] = np.nan  # region 0 loses part of its pixels in the last band
+    return stack
+
+
+def _reference(stack, geometries):
+    ''' One full-grid mask and one masked copy per region and per band, as before ZonalStats '''
+    out = {name: np.full((stack.shape[0], len(geometries)), np.nan) for name in ('count', 'mean', 'std', 'min', 'max')}
+    for i, geometry in enumerate(geometries):
+        mask = geometry_mask([geometry], out_shape=SHAPE, transform=TRANSFORM, invert=True)
+        for b, band in enumerate(stack):
+            values = band[mask].astype(np.float64)
+            values = values[~np.isnan(values)]
+            out['count'][b, i] = values.size
+            if values.size:
+                out['mean'][b, i], out['std'][b, i] = values.mean(), values.std()
+                out['min'][b, i], out['max'][b, i] = values.min(), values.max()
+    return out
+
+
+def _check(stats, reference):
+    np.testing.assert_array_equal(stats['count'], reference['count'])
+    for name in ('mean', 'std', 'min', 'max'):
+        np.testing.assert_allclose(stats[name], reference[name], rtol=1e-9, atol=1e-9, equal_nan=True)
+
+
+def test_zonal_stats_match_full_grid_masks():
+    stack = _stack()
+    zonal = ZonalStats.from_geometries(GEOMETRIES, SHAPE, TRANSFORM)
+    _check(zonal.stats(stack), _reference(stack, GEOMETRIES))
+    assert zonal.stats(stack)['count'][0, 4] == 0
+
+
+def test_zonal_stats_single_raster():
+    stack = _stack()[:1]
+    stats = ZonalStats.from_geometries(GEOMETRIES, SHAPE, TRANSFORM).stats(stack[0], statistics=('count', 'mean'))
+    assert set(stats) == {'count', 'mean'}
+    reference = _reference(stack, GEOMETRIES)
+    np.testing.assert_array_equal(stats['count'], reference['count'])
+    np.testing.assert_allclose(stats['mean'], reference['mean'], rtol=1e-9, equal_nan=True)
+
+
+def test_zonal_stats_are_cached():
+    first = ZonalStats.from_geometries(GEOMETRIES, SHAPE, TRANSFORM)
+    assert ZonalStats.from_geometries(list(GEOMETRIES), SHAPE, TRANSFORM) is first
+    assert ZonalStats.from_geometries(GEOMETRIES[:2], SHAPE, TRANSFORM) is not first
+
+
+def test_zonal_stats_from_file_matches_in_memory(tmp_path):
+    stack = _stack()
+    nodata = -9999.0
+    file_name = str(tmp_path / 'stack.tif')
+    with rasterio.open(file_name, 'w', driver='GTiff', height=SHAPE[0], width=SHAPE[1], count=stack.shape[0],
+                       dtype='float32', crs='EPSG:4326', transform=TRANSFORM, nodata=nodata) as dst:
+        dst.write(np.where(np.isnan(stack), nodata, stack))
+
+    _check(zonal_stats_from_file(file_name, GEOMETRIES), _reference(stack, GEOMETRIES))
+    stats = zonal_stats_from_file(file_name, GEOMETRIES, bands=[2], statistics=('mean',))
+    np.testing.assert_allclose(stats['mean'], _reference(stack[1:2], GEOMETRIES)['mean'], rtol=1e-9, equal_nan=True)
+
+
+def _block_reference(array, factor, reduce):
+    height, width = array.shape[-2] // factor, array.shape[-1] // factor
+    blocks = array[..., :height * factor, :width * factor].astype(np.float64)
+    blocks = blocks.reshape(*array.shape[:-2], height, factor, width, factor)
+    return reduce(blocks, axis=(-3, -1))
+
+
+@pytest.mark.parametrize('factor', [1, 3, 10])
+@pytest.mark.parametrize('method, reduce', [('mean', np.mean), ('max', np.max), ('min', np.min)])
+def test_downsample_matches_block_reduction(factor, method, reduce):
+    array = np.random.default_rng(1).normal(size=(2, 95, 203)).astype(np.float32)
+    data = downsample(array, factor, method=method)
+    assert data.dtype == np.float32 and data.shape == (2, 95 // factor, 203 // factor)
+    np.testing.assert_allclose(data, _block_reference(array, factor, reduce), rtol=1e-5, atol=1e-5)
+
+
+def test_downsample_ignores_nodata():
+    array = np.random.default_rng(2).integers(-100, 100, size=(40, 60)).astype(np.int16)
+    array[:10, :20] = -32768  # whole blocks of nodata
+    array[15, 25] = -32768
+    data = downsample(array, 10, nodata=-32768)
+
+    masked = np.where(array == -32768, np.nan, array.astype(np.float64))
+    with np.errstate(invalid='ignore'), pytest.warns(RuntimeWarning):
+        reference = _block_reference(masked, 10, np.nanmean)
+    assert np.isnan(data[0, :2]).all()
+    np.testing.assert_allclose(data, reference, rtol=1e-5, equal_nan=True)
+
+
+@pytest.mark.parametrize('dtype, nodata, factor', [(np.uint16, 65535, 30), (np.int32, -9999, 4), (np.int16, -32768, 7)])
+def test_downsample_integer_nodata_is_exact(dtype, nodata, factor):
+    info = np.iinfo(dtype)
+    array = np.random.default_rng(5).integers(max(info.min, -40000), min(info.max, 40000), size=(65, 95)).astype(dtype)
+    array[::3, ::2] = nodata
+    array[:factor, :factor] = nodata
+    data = downsample(array, factor, nodata=nodata)
+
+    masked = np.where(array == nodata, np.nan, array.astype(np.float64))
+    with np.errstate(invalid='ignore'), pytest.warns(RuntimeWarning):
+        reference = _block_reference(masked, factor, np.nanmean)
+    assert np.isnan(data[0, 0])
+    np.testing.assert_allclose(data, reference, rtol=1e-6, equal_nan=True)
+    np.testing.assert_array_equal(downsample(array, factor, method='nanmean', nodata=nodata), data)
+
+
+def test_downsample_nanmean():
+    array = np.random.default_rng(3).normal(size=(30, 30)).astype(np.float32)
+    array[::4, ::3] = np.nan
+    np.testing.assert_allclose(downsample(array, 5, method='nanmean'), _block_reference(array, 5, np.nanmean), rtol=1e-5)
+
+
+def test_downsample_matches_avg_pool():
+    ''' Same output as the torch.nn.AvgPool2d(kernel_size=10, stride=10) previously used by load_geotiff '''
+    torch = pytest.importorskip('torch')
+    array = np.random.default_rng(4).normal(280, 20, size=(208, 433)).astype(np.float32)
+    pooled = torch.nn.AvgPool2d(kernel_size=10, stride=10)(torch.tensor(array[None, None])).numpy()[0, 0]
+    np.testing.assert_allclose(downsample(array, 10), pooled, rtol=1e-6)
+
+
+def test_downsample_rejects_bad_arguments():
+    with pytest.raises(ValueError):
+        downsample(np.zeros((4, 4)), 2, method='median')
+    with pytest.raises(ValueError):
+        downsample(np.zeros((4, 4)), 0)
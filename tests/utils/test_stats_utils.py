@@ -0,0 +1,163 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.utils.stats_utils import GroupedTDigest, RatingCube, RatingStatistics, TDigest, compute_rating_statistics
+
+
+def _ratings(n=20000, seed=0):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        'location_user': rng.choice(['Belgium', 'United States, Texas', 'Germany', 'Canada'], n),
+        'beer_name': rng.choice([f'beer {i}' for i in range(300)], n),
+        'rating': np.round(rng.uniform(1, 5, n), 2),
+    })
+    df.loc[::97, 'rating'] = np.nan
+    return df
+
+
+def _reference(df):
+    grouped = df.groupby(['location_user', 'beer_name'])['rating']
+    reference = grouped.agg(avg_score='mean', std_score='std', num_ratings='count')
+    return reference[reference['num_ratings'] > 0].astype(np.float64)
+
+
+def _check(stats, df):
+    summary = stats.summary().sort_index()
+    reference = _reference(df).sort_index()
+    pd.testing.assert_index_equal(summary.index, reference.index)
+    np.testing.assert_allclose(summary.to_numpy(), reference.to_numpy(), rtol=1e-9, atol=1e-12)
+
+
+def test_rating_statistics_chunked_updates_match_groupby():
+    df = _ratings()
+    stats = RatingStatistics()
+    for start in range(0, len(df), 3000):
+        stats.update(df.iloc[start:start + 3000])
+    _check(stats, df)
+
+
+def test_rating_statistics_merge_matches_groupby():
+    df = _ratings()
+    parts = [RatingStatistics().update(df.iloc[start:start + 4000]) for start in range(0, len(df), 4000)]
+    merged = parts[0]
+    for part in parts[1:]:
+        merged.merge(part)
+    _check(merged, df)
+
+
+@pytest.mark.parametrize("n_jobs", [1, 2])
+def test_compute_rating_statistics_from_lazy_chunks(n_jobs):
+    df = _ratings()
+    chunks = (df.iloc[start:start + 1500] for start in range(0, len(df), 1500))
+    _check(compute_rating_statistics(chunks, n_jobs=n_jobs), df)
+
+
+def test_rating_statistics_transform_broadcasts_like_groupby():
+    df = _ratings(2000)
+    stats = RatingStatistics().update(df)
+    out = stats.transform(df)
+    expected = df.groupby(['location_user', 'beer_name'])['rating'].transform('mean')
+    np.testing.assert_allclose(out['avg_score'].to_numpy(), expected.to_numpy(), rtol=1e-12)
+
+
+@pytest.mark.parametrize("distribution", ["uniform", "normal", "discrete"])
+def test_tdigest_quantiles_within_rank_error(distribution):
+    rng = np.random.default_rng(1)
+    values = {
+        'uniform': rng.uniform(0, 5, 200000),
+        'normal': rng.normal(3, 0.7, 200000),
+        'discrete': np.round(rng.uniform(1, 5, 200000) * 4) / 4,
+    }[distribution]
+    epsilon = 0.005
+
+    digest = TDigest(epsilon)
+    for chunk in np.array_split(values, 7):
+        digest.update(chunk)
+
+    q = np.linspace(0.01, 0.99, 41)
+    estimates = digest.quantile(q)
+    exact = np.sort(values)
+    # Rank error: the data values around every estimate must have ranks within epsilon of q (an estimate
+    # interpolated between two atoms of discrete data takes the ranks of both atoms)
+    below = exact[np.clip(np.searchsorted(exact, estimates, side='right') - 1, 0, len(exact) - 1)]
+    above = exact[np.clip(np.searchsorted(exact, estimates, side='left'), 0, len(exact) - 1)]
+    rank_below = np.searchsorted(exact, below, side='left') / len(exact)
+    rank_at_or_below = np.searchsorted(exact, above, side='right') / len(exact)
+    assert np.all(rank_below <= q + epsilon) and np.all(rank_at_or_below >= q - epsilon)
+
+
+def test_grouped_tdigest_merge_matches_np_quantile():
+    df = _ratings(60000).dropna()
+    halves = [df.iloc[:len(df) // 2], df.iloc[len(df) // 2:]]
+    digests = [GroupedTDigest(0.005).update(part['location_user'], part['rating']) for part in halves]
+    merged = digests[0].merge(digests[1])
+
+    estimates = merged.quantile(0.9).sort_index()
+    exact = df.groupby('location_user')['rating'].quantile(0.9).sort_index()
+    np.testing.assert_allclose(estimates.to_numpy(), exact.to_numpy(), atol=0.05)
+
+
+def _labelled_ratings(n=20000, seed=2):
+    """ Ratings labelled like calculate_ratings_by_country, with missing items and aspect scores """
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        'country_user': rng.choice(['Canada', 'Belgium', 'Germany'], n),
+        'beer_name': rng.choice([f'beer {i}' for i in range(60)], n).astype(object),
+        'style_category': rng.choice(['Stout', 'IPA', 'Lager'], n).astype(object),
+        'rating_label_per_country': rng.choice(['liked', 'neutral', 'disliked'], n),
+        'rating': np.round(rng.uniform(0.5, 5, n), 2),
+        'std_score_per_country': rng.gamma(2, 0.3, n),
+    })
+    for column in ('aroma', 'palate', 'taste', 'appearance', 'avg_score_per_country'):
+        df[column] = rng.uniform(1, 5, n)
+    df.loc[::53, 'beer_name'] = np.nan
+    df.loc[::41, 'style_category'] = np.nan  # styles missing from the style mapping
+    df.loc[::29, 'aroma'] = np.nan
+    return df
+
+
+@pytest.mark.parametrize("item", ['beer_name', 'style_category'])
+def test_rating_cube_item_means_match_radar_chart_path(item):
+    df = _labelled_ratings()
+    cube = RatingCube.from_frame(df, item=item)
+
+    # Per-item means as computed from df by plot_radar_chart
+    df_filtered = df[(df['country_user'] == 'Canada') & (df['rating_label_per_country'] == 'liked')].copy()
+    df_filtered['beer_names_count'] = df_filtered[item]
+    reference = df_filtered.groupby(item).agg({
+        'aroma': 'mean', 'palate': 'mean', 'taste': 'mean', 'appearance': 'mean',
+        'avg_score_per_country': 'mean', 'std_score_per_country': 'mean', 'beer_names_count': 'count'
+    }).reset_index()
+
+    means = cube.item_means('Canada', 'liked').sort_values(item).reset_index(drop=True)
+    pd.testing.assert_frame_equal(means, reference, check_dtype=False, rtol=1e-9)
+
+
+def test_rating_cube_histograms_match_distribution_path():
+    df = _labelled_ratings()
+    df.loc[5, 'rating'] = np.nan
+    cube = RatingCube.from_frame(df)
+
+    for country in ('Canada', 'Belgium'):
+        df_country = df[df['country_user'] == country]
+        rating_counts, rating_edges, std_counts, std_edges = cube.histograms(country)
+        # Values outside the edges are clipped into the first or last bin
+        expected_ratings = np.histogram(df_country['rating'].dropna().clip(rating_edges[0], rating_edges[-1]), bins=rating_edges)[0]
+        expected_std = np.histogram(df_country['std_score_per_country'].clip(std_edges[0], std_edges[-1]), bins=std_edges)[0]
+        np.testing.assert_array_equal(rating_counts, expected_ratings)
+        np.testing.assert_array_equal(std_counts, expected_std)
+
+    liked = df[(df['country_user'] == 'Canada') & (df['rating_label_per_country'] == 'liked')]
+    assert cube.histograms('Canada', 'liked')[0].sum() == liked['rating'].notna().sum()
+
+
+def test_rating_cube_polarizing_threshold_matches_quantile():
+    df = _labelled_ratings()
+    epsilon = 0.005
+    cube = RatingCube.from_frame(df, epsilon=epsilon)
+    estimate = cube.polarizing_threshold(0.9)
+
+    values = df['std_score_per_country'].to_numpy()
+    assert np.mean(values < estimate) <= 0.9 + epsilon and np.mean(values <= estimate) >= 0.9 - epsilon
+    assert abs(estimate - df['std_score_per_country'].quantile(0.9)) < 0.02